@@ -0,0 +1,567 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright ⓒ 2017 Daniel Keep.
+#
+# Licensed under the MIT license (see LICENSE or <http://opensource.org
+# /licenses/MIT>) or the Apache License, Version 2.0 (see LICENSE of
+# <http://www.apache.org/licenses/LICENSE-2.0>), at your option. All
+# files in the project carrying such notice may not be copied, modified,
+# or distributed except according to those terms.
+
+"""
+Usage: bench-decrepit.py [options] [--] [<decrepit-arg>...]
+       bench-decrepit.py --startup [--budget=<MS>] [options]
+
+Benchmark `decrepit.py` without touching the network.  This serves fake
+package pages for every distro `decrepit.py` knows about from a local HTTP
+server, points `decrepit.py` at it with `--mirror`, and reports how long each
+run took, how long each distro took, peak memory use, and how many requests
+and connections were made.
+
+Each run is done in a fresh process, for each of three scenarios:
+
+- cold: empty cache.
+- warm: cache from the previous run, but every page has to be revalidated.
+- hot:  cache from the previous run, and every page is still fresh.
+
+Any extra arguments are passed through to `decrepit.py`.
+
+With `--startup`, this instead measures how long `decrepit.py` spends
+importing modules (using `python -X importtime`) when listing distros,
+answering from a fresh cache, and scraping with an empty cache.  Modules the
+interpreter loads for an empty script (`site`, `encodings`, ...) aren't
+counted.  It exits with a non-zero status if listing distros takes longer
+than `--budget` to import, or if any path imports a module it has no
+business loading; use it to catch imports creeping back into the start-up
+path.
+
+Options:
+  --budget=<MS>         Import time budget for listing distros, for
+                        `--startup`. [default: 60]
+  -h, --help            Show help.
+  -J, --json            Output results as JSON.
+  -n, --runs=<N>        Runs of each scenario. [default: 3]
+  --bandwidth=<KBPS>    Bandwidth of each response, in KB/s.  0 means no
+                        limit. [default: 0]
+  --latency=<MS>        Delay before each response. [default: 50]
+  --nixos-mb=<MB>       Rough size of the uncompressed NixOS package
+                        metadata. [default: 64]
+"""
+
+__requirements__ = """
+docopt==0.6.2
+tabulate==0.7.7
+"""
+
+import docopt
+import gzip
+import hashlib
+import http.server
+import json
+import os
+import os.path
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from tabulate import tabulate
+
+DECREPIT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'decrepit.py')
+
+RE_TOOK = re.compile(r"^get_dispatch[(]'(?P<distro>[^']+)', '[^']*'[)]: took (?P<secs>[0-9.e-]+) seconds$", re.M)
+
+RE_IMPORT_TIME = re.compile(r'^import time:\s+(?P<self>\d+) \|\s+(?P<cumulative>\d+) \| (?P<indent>\s*)(?P<module>\S+)$', re.M)
+
+STARTUP_PATHS = [
+    # (name, decrepit args, warm the cache first?, modules it mustn't import)
+    ('list', ['-l'], None,
+        ['lxml', 'tabulate', 'http.client', 'urllib.request', 'concurrent.futures',
+            'tempfile']),
+    ('cached', ['-a', '--cache-ttl=1000000'], True,
+        ['http.client', 'http.server', 'urllib.request']),
+    ('scrape', ['-a', '--cache-ttl=0'], False,
+        ['http.server']),
+]
+
+SCENARIOS = [
+    # (name, extra decrepit args, clear cache first?)
+    ('cold', ['--cache-ttl=0'], True),
+    ('warm', ['--cache-ttl=0'], False),
+    ('hot', ['--cache-ttl=1000000'], False),
+]
+
+def main():
+    args = docopt.docopt(__doc__)
+    if args['--startup']:
+        return main_startup(args)
+    runs = int(args['--runs'])
+    extra_args = args['<decrepit-arg>']
+
+    fixtures = Fixtures(nixos_bytes=int(float(args['--nixos-mb'])*1024*1024))
+    server = FixtureServer(
+        fixtures,
+        latency = float(args['--latency'])/1000.0,
+        bandwidth = float(args['--bandwidth'])*1024,
+    )
+    server.start()
+    cache_dir = tempfile.mkdtemp(prefix='decrepit-bench-')
+    state_dir = tempfile.mkdtemp(prefix='decrepit-bench-state-')
+
+    results = []
+    try:
+        for (scenario, scenario_args, clear_cache) in SCENARIOS:
+            for run in range(runs):
+                if clear_cache:
+                    shutil.rmtree(cache_dir, ignore_errors=True)
+                result = run_decrepit(server, cache_dir, state_dir, scenario_args + extra_args)
+                result['scenario'] = scenario
+                result['run'] = run
+                results.append(result)
+    finally:
+        server.stop()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+    if args['--json']:
+        print(json.dumps(results, sort_keys=True, indent=2))
+    else:
+        print_report(results)
+
+    if any(r['status'] not in (0, None) for r in results):
+        return 1
+
+def main_startup(args):
+    runs = int(args['--runs'])
+    budget_ms = float(args['--budget'])
+
+    fixtures = Fixtures(nixos_bytes=int(float(args['--nixos-mb'])*1024*1024))
+    server = FixtureServer(fixtures, latency=0, bandwidth=0)
+    server.start()
+    cache_dir = tempfile.mkdtemp(prefix='decrepit-bench-')
+    state_dir = tempfile.mkdtemp(prefix='decrepit-bench-state-')
+
+    results = []
+    try:
+        baseline = frozenset(run_importtime(['-c', 'pass'])['modules'])
+        for (path, path_args, warm_cache, _) in STARTUP_PATHS:
+            if warm_cache is not None:
+                path_args = [
+                    '--mirror=%s' % server.url,
+                    '--cache-dir=%s' % cache_dir,
+                    '--state-dir=%s' % state_dir,
+                    '--fresh',
+                ] + path_args
+            for run in range(runs):
+                if warm_cache is False:
+                    shutil.rmtree(cache_dir, ignore_errors=True)
+                elif warm_cache and run == 0:
+                    run_startup(path_args, baseline)
+                result = run_startup(path_args, baseline)
+                result['path'] = path
+                result['run'] = run
+                results.append(result)
+    finally:
+        server.stop()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+    problems = []
+    for (path, _, _, banned) in STARTUP_PATHS:
+        rs = [r for r in results if r['path'] == path]
+        for r in rs:
+            if r['status'] not in (0, None):
+                problems.append('%s run %d exited with status %r' % (path, r['run'], r['status']))
+        imported = sorted({m for r in rs for m in r['modules']
+            if any(m == b or m.startswith(b + '.') for b in banned)})
+        if len(imported) > 0:
+            problems.append('%s imported %s' % (path, ', '.join(imported)))
+    list_ms = statistics.median(r['own_import_ms'] for r in results if r['path'] == 'list')
+    if list_ms > budget_ms:
+        problems.append('list took %.1fms to import; the budget is %.1fms' % (list_ms, budget_ms))
+
+    if args['--json']:
+        print(json.dumps({'runs': results, 'problems': problems}, sort_keys=True, indent=2))
+    else:
+        print_startup_report(results)
+        for problem in problems:
+            print('')
+            print(problem)
+
+    if len(problems) > 0:
+        return 1
+
+def run_startup(args, baseline):
+    """
+    Run `decrepit.py` once with `-X importtime`, measuring its imports.
+    Modules in `baseline` are left out of `own_import_ms` and `top_level`.
+    """
+    result = run_importtime([DECREPIT] + args)
+    result['own_import_ms'] = sum(
+        self_us for (module, self_us) in result.pop('self_us').items()
+        if module not in baseline
+    ) / 1000.0
+    result['top_level'] = {
+        module: ms for (module, ms) in result['top_level'].items()
+        if module not in baseline
+    }
+    return result
+
+def run_importtime(args):
+    """
+    Run Python with `-X importtime` and the given arguments.
+    """
+    cmd = [sys.executable, '-X', 'importtime'] + args
+    start = time.perf_counter()
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    wall = time.perf_counter() - start
+    stderr = proc.stderr.decode('utf-8', 'replace')
+
+    imports = [
+        (m.group('module'), int(m.group('self')), int(m.group('cumulative')), len(m.group('indent')) == 0)
+        for m in RE_IMPORT_TIME.finditer(stderr)
+    ]
+    # `-X importtime` reports in microseconds.
+    return {
+        'status': proc.returncode,
+        'wall_ms': wall * 1000.0,
+        'import_ms': sum(self_us for (_, self_us, _, _) in imports) / 1000.0,
+        'self_us': {module: self_us for (module, self_us, _, _) in imports},
+        'modules': [module for (module, _, _, _) in imports],
+        'top_level': {
+            module: cumulative_us / 1000.0
+            for (module, _, cumulative_us, top) in imports
+            if top
+        },
+    }
+
+def print_startup_report(results):
+    table = []
+    for (path, _, _, _) in STARTUP_PATHS:
+        rs = [r for r in results if r['path'] == path]
+        if len(rs) == 0:
+            continue
+        heaviest = sorted(rs[-1]['top_level'].items(), key=lambda mt: -mt[1])[:4]
+        table.append((
+            path,
+            '%.1f' % statistics.median(r['wall_ms'] for r in rs),
+            '%.1f' % statistics.median(r['import_ms'] for r in rs),
+            '%.1f' % statistics.median(r['own_import_ms'] for r in rs),
+            len(rs[-1]['modules']),
+            ', '.join('%s (%.1f)' % mt for mt in heaviest),
+        ))
+    print(tabulate(table, headers=[
+        'Path', 'Median (ms)', 'Imports (ms)', 'Own imports (ms)', 'Modules', 'Heaviest imports (ms)',
+    ]))
+
+def run_decrepit(server, cache_dir, state_dir, args):
+    """
+    Run `decrepit.py` once against the fixture server, measuring it.
+    """
+    cmd = [
+        sys.executable, DECREPIT, '-a', '-v', '--json',
+        '--mirror=%s' % server.url,
+        '--cache-dir=%s' % cache_dir,
+        '--state-dir=%s' % state_dir,
+        '--fresh',
+    ] + args
+    server.reset_stats()
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # `communicate` would reap the child itself, so read the output on a
+    # thread and use `wait4` to get the child's resource usage.
+    output = {}
+    def read(name, f):
+        output[name] = f.read().decode('utf-8', 'replace')
+    readers = [
+        threading.Thread(target=read, args=('stdout', proc.stdout)),
+        threading.Thread(target=read, args=('stderr', proc.stderr)),
+    ]
+    for reader in readers:
+        reader.start()
+    (_, wait_status, rusage) = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - start
+    for reader in readers:
+        reader.join()
+    proc.returncode = os.waitstatus_to_exitcode(wait_status)
+
+    distro_secs = {}
+    for m in RE_TOOK.finditer(output['stderr']):
+        distro_secs[m.group('distro')] = float(m.group('secs'))
+
+    stats = server.stats()
+    return {
+        'status': proc.returncode,
+        'wall_secs': wall,
+        # `ru_maxrss` is in kilobytes on Linux.
+        'peak_rss_kb': rusage.ru_maxrss,
+        'distro_secs': distro_secs,
+        'requests': stats['requests'],
+        'not_modified': stats['not_modified'],
+        'connections': stats['connections'],
+        'bytes_sent': stats['bytes_sent'],
+        'output': output['stdout'],
+    }
+
+def print_report(results):
+    scenarios = []
+    for (scenario, _, _) in SCENARIOS:
+        rs = [r for r in results if r['scenario'] == scenario]
+        if len(rs) == 0:
+            continue
+        scenarios.append((scenario, rs))
+
+    table = []
+    for (scenario, rs) in scenarios:
+        table.append((
+            scenario,
+            '%.3f' % statistics.median(r['wall_secs'] for r in rs),
+            '%.3f' % max(r['wall_secs'] for r in rs),
+            '%.1f' % (max(r['peak_rss_kb'] for r in rs) / 1024.0),
+            '%.1f' % statistics.mean(r['requests'] for r in rs),
+            '%.1f' % statistics.mean(r['not_modified'] for r in rs),
+            '%.1f' % statistics.mean(r['connections'] for r in rs),
+            '%.1f' % (statistics.mean(r['bytes_sent'] for r in rs) / 1024.0),
+        ))
+    print(tabulate(table, headers=[
+        'Scenario', 'Median (s)', 'Max (s)', 'Peak RSS (MB)',
+        'Requests', '304s', 'Connections', 'Sent (KB)',
+    ]))
+    print('')
+
+    distros = sorted({d for r in results for d in r['distro_secs']})
+    table = []
+    for distro in distros:
+        row = [distro]
+        for (_, rs) in scenarios:
+            secs = [r['distro_secs'][distro] for r in rs if distro in r['distro_secs']]
+            row.append('%.3f' % statistics.median(secs) if secs else '')
+        table.append(row)
+    print(tabulate(table, headers=['Distro'] + [
+        '%s (s)' % scenario for (scenario, _) in scenarios
+    ]))
+
+    failed = [r for r in results if r['status'] not in (0, None)]
+    for r in failed:
+        print('')
+        print('%s run %d exited with status %r' % (r['scenario'], r['run'], r['status']))
+
+class Fixtures:
+    """
+    Fake versions of the pages `decrepit.py` scrapes.
+
+    Pages are matched against the mirrored path (`/host/path?query`), so the
+    release being asked for can be pulled out of it.
+    """
+    RUST_VER = '1.22.1'
+
+    def __init__(self, nixos_bytes):
+        self.routes = [
+            (r'^/www[.]archlinux[.]org/packages/community/x86_64/rust/$', self.arch),
+            (r'^/packages[.](debian[.]org|ubuntu[.]com)/(?P<release>[^/]+)/rustc$', self.debian),
+            (r'^/build[.]opensuse[.]org/package/view_file/openSUSE:Leap:(?P<release>[^/]+)/rust/rust[.]spec', self.opensuse),
+            (r'^/apps[.]fedoraproject[.]org/packages/fcomm_connector/bodhi/query/query_active_releases/', self.fedora),
+            (r'^/svnweb[.]freebsd[.]org/ports/branches/(?P<release>[^/]+)/lang/rust/Makefile[?]', self.freebsd_makefile),
+            (r'^/svnweb[.]freebsd[.]org/ports/branches/(?P<release>[^/]+)/lang/rust/?$', self.freebsd_dir),
+            (r'^/cvsweb[.]openbsd[.]org/cgi-bin/cvsweb/~checkout~/ports/lang/rust/Makefile[?]', self.openbsd_makefile),
+            (r'^/cvsweb[.]openbsd[.]org/cgi-bin/cvsweb/ports/lang/rust/[?]', self.openbsd_dir),
+            (r'^/nixos[.]org/nixpkgs/packages[.]json[.]gz$', self.nixos),
+        ]
+        self.routes = [(re.compile(r), f) for (r, f) in self.routes]
+        self.nixos_bytes = nixos_bytes
+        self.nixos_gz = None
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        """
+        Returns `(content_type, body)` for a path, or `None`.
+        """
+        for (regex, func) in self.routes:
+            m = regex.match(path)
+            if m is not None:
+                return func(**m.groupdict())
+        return None
+
+    def html(self, body):
+        # Bulk the page out a bit, so that there's something to skip.
+        filler = '<p>%s</p>\n' % ('Lorem ipsum dolor sit amet. ' * 8)
+        page = '<!DOCTYPE html>\n<html><head><title>rust</title></head><body>\n%s\n%s</body></html>\n'
+        return ('text/html; charset=utf-8', (page % (body, filler * 200)).encode('utf-8'))
+
+    def text(self, body):
+        return ('text/plain; charset=utf-8', body.encode('utf-8'))
+
+    def arch(self):
+        return self.html('<h2>rust 1:%s-1</h2>' % self.RUST_VER)
+
+    def debian(self, release):
+        return self.html('<h1>Package: rustc (%s+dfsg1-1) [%s]</h1>' % (self.RUST_VER, release))
+
+    def opensuse(self, release):
+        return self.html('<pre>Name:           rust\nVersion:        %s\nRelease:        0\n</pre>' % self.RUST_VER)
+
+    def fedora(self):
+        rows = [
+            {
+                'release': 'Fedora %d' % rel,
+                'stable_version': '<a href="#">%s-1.fc%d</a>' % (self.RUST_VER, rel),
+            }
+            for rel in range(24, 29)
+        ]
+        return ('application/json', json.dumps({'rows': rows}).encode('utf-8'))
+
+    def freebsd_dir(self, release):
+        rows = ''.join(
+            '<tr><td><a href="#">\n%s</a></td><td><a href="#"><strong>%d</strong></a></td></tr>\n' % (name, rev)
+            for (name, rev) in [('Makefile', 455000), ('distinfo', 455001), ('files/', 454000), ('pkg-descr', 400000)]
+        )
+        return self.html('<table>\n%s</table>' % rows)
+
+    def freebsd_makefile(self, release):
+        return self.text('# $FreeBSD: branches/%s/lang/rust/Makefile 455000 2017-11-28 10:00:00Z user $\n\n'
+            'PORTNAME=\trust\nPORTVERSION?=\t%s\nCATEGORIES=\tlang\n' % (release, self.RUST_VER))
+
+    def openbsd_dir(self):
+        rows = ''.join(
+            '<tr><td><a href="#">log</a> <a href="#">dir</a> <a href="#">%s</a></td><td><a href="#"><b>%s</b></a></td></tr>\n' % (name, rev)
+            for (name, rev) in [('Makefile', '1.55'), ('distinfo', '1.30'), ('pkg/', '1.2')]
+        )
+        return self.html('<table>\n%s</table>' % rows)
+
+    def openbsd_makefile(self):
+        return self.text('# $OpenBSD: Makefile,v 1.55 2017/11/28 10:00:00 user Exp $\n\n'
+            'COMMENT =\tcompiler for Rust Language\nV =\t\t%s\n' % self.RUST_VER)
+
+    def nixos(self):
+        with self.lock:
+            if self.nixos_gz is None:
+                self.nixos_gz = self.make_nixos()
+        return ('application/gzip', self.nixos_gz)
+
+    def make_nixos(self):
+        """
+        Generate a NixOS package metadata file of roughly the configured size,
+        with `rustc` somewhere in the middle as it would be in the real thing.
+        """
+        rng = random.Random(0)
+        words = ['lib', 'tool', 'fast', 'utility', 'gnome', 'kde', 'python', 'haskell', 'server', 'client']
+        pkgs = []
+        size = 0
+        n = 0
+        while size < self.nixos_bytes:
+            attr = '%s-%s%d' % (rng.choice(words), rng.choice(words), n)
+            desc = ' '.join(rng.choice(words) for _ in range(20))
+            entry = '"%s":{"name":"%s-%d.%d","system":"x86_64-linux","meta":{"description":"%s"}}' % (
+                attr, attr, rng.randint(0, 9), rng.randint(0, 99), desc)
+            pkgs.append((attr, entry))
+            size += len(entry) + 1
+            n += 1
+        pkgs.append(('rustc', '"rustc":{"name":"rustc-%s","system":"x86_64-linux","meta":{}}' % self.RUST_VER))
+        pkgs.append(('cargo', '"cargo":{"name":"cargo-0.23.0","system":"x86_64-linux","meta":{}}'))
+        pkgs.sort()
+        doc = '{"version":2,"packages":{%s}}' % ','.join(e for (_, e) in pkgs)
+        return gzip.compress(doc.encode('utf-8'), compresslevel=6)
+
+class QuietHTTPServer(http.server.ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # `decrepit.py` hangs up early when it's found what it wants.
+        pass
+
+class FixtureServer:
+    """
+    Serves `Fixtures` over HTTP/1.1 with keep-alive, simulated latency and
+    bandwidth, and support for conditional requests.
+    """
+    def __init__(self, fixtures, latency, bandwidth):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+        bench = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                bench.count('connections')
+
+            def do_GET(self):
+                bench.count('requests')
+                if bench.latency > 0:
+                    time.sleep(bench.latency)
+                page = bench.fixtures.get(self.path)
+                if page is None:
+                    self.send_error(404)
+                    return
+                (content_type, body) = page
+                etag = '"%s"' % hashlib.sha1(body).hexdigest()
+                if self.headers.get('if-none-match') == etag:
+                    bench.count('not_modified')
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etag)
+                self.end_headers()
+                self.send_body(body)
+
+            def send_body(self, body):
+                chunk_size = 16*1024
+                try:
+                    for i in range(0, len(body), chunk_size):
+                        chunk = body[i:i+chunk_size]
+                        self.wfile.write(chunk)
+                        bench.count('bytes_sent', len(chunk))
+                        if bench.bandwidth > 0:
+                            time.sleep(len(chunk) / bench.bandwidth)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client stopped reading early.
+                    self.close_connection = True
+
+            def log_message(self, fmt, *args):
+                pass
+
+        self.httpd = QuietHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d' % self.httpd.server_port
+
+    def start(self):
+        # Build the big file up front, so it doesn't count against the first run.
+        self.fixtures.nixos()
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def reset_stats(self):
+        with self.lock:
+            self.counts = {
+                'requests': 0,
+                'not_modified': 0,
+                'connections': 0,
+                'bytes_sent': 0,
+            }
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+if __name__ == '__main__':
+    sys.exit(main())
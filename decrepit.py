@@ -10,9 +10,14 @@
 # or distributed except according to those terms.
 
 """
-Usage: decrepit.py [-fv] [--distro=<NAME>]... [DATE]
-       decrepit.py -a [-fRv] [--markdown | --json] [--distro=<NAME>]... [DATE]
+Usage: decrepit.py [options] [-fv] [--distro=<NAME>]... [--package=<NAME>]... [DATE]
+       decrepit.py -a [options] [-fRv] [--markdown | --json] [--distro=<NAME>]... [--package=<NAME>]... [DATE]
+       decrepit.py --from=<DATE> [--to=<DATE>] [--step=<DAYS>] [options] [-afRv] [--markdown | --json] [--distro=<NAME>]...
        decrepit.py -l [-v] [DATE]
+       decrepit.py --serve [--listen=<ADDR>] [--refresh=<SECS>] [options] [-v]
+       decrepit.py --stats [--prometheus] [options] [-v] [--distro=<NAME>]...
+       decrepit.py --export=<FILE> [options] [-v]
+       decrepit.py --import=<FILE>... [options] [-v]
 
 Determine the oldest supported version of Rust in the wild.  Sort of.  This
 script scrapes public package repository information for the packaged version
@@ -25,18 +30,99 @@ Arguments:
   DATE      'As of' date: uses (potentially historical) data that is not more
             recent than this date, specified as 'YYYY-MM-DD'.
 
+When `--from` is given, the results for a range of dates are shown instead.
+Each distinct distro release is only looked up once, no matter how many dates
+it appears in.
+
 Options:
   -a, --all             Show all supported versions.
+  --budget=<SECS>       Time budget for `--fast`. [default: 5]
   -d, --distro=<NAME>   Check a specific distribution.  Use `name:release` to
                         specify a particular release.
-  -f, --fast            Skip distros that are slow (>5 seconds) to check.
+  -f, --fast            Use the last known version for distros which have
+                        usually taken longer than `--budget` to check.
   -h, --help            Show help.
   -J, --json            Format output as JSON.
   -l, --list-distros    List known distros.
   -M, --markdown        Format table for Markdown.
+  -p, --package=<NAME>  Check this package instead of `rust`.  Can be given
+                        more than once.
   -R, --show-release    Show distribution releases.
   -v, --verbose         Show more information during operation.
   -V, --version         Show version.
+
+With `--serve`, decrepit keeps looked-up versions in memory, refreshes them in
+the background, and answers queries from other invocations that pass
+`--server` (or set `DECREPIT_SERVER`).  Those fall back to looking things up
+themselves if the server can't be reached.  The server looks versions up with
+its own settings, so queries that give network or cache options are answered
+locally instead.
+
+Every lookup's timings and outcome are recorded.  `--stats` summarises them
+per distro for `rust`, or prints them in the Prometheus text format with
+`--prometheus`.
+
+With `--package`, the oldest version of each package is shown instead, or
+with `--all`, a table of distros against packages.  The known packages are
+`rust`, `cargo`, `llvm` and `rust-src`, though not every distro has all of
+them.  Documents that hold several packages are only fetched once.
+
+Every version looked up is remembered, along with the date it was looked up
+on.  Queries about past dates are answered from that history where possible,
+rather than from what the distros ship today.  The history can be shared with
+`--export` and `--import`.
+
+Date range options:
+  --from=<DATE>         First date to report on.
+  --to=<DATE>           Last date to report on.  Defaults to today.
+  --step=<DAYS>         Report every this many days.  Defaults to reporting
+                        each date on which the supported releases change.
+
+History options:
+  --export=<FILE>       Write the version history to a file (or `-` for
+                        stdout) as JSON lines.
+  --import=<FILE>       Add the versions in a file written by `--export` to
+                        the history.  Versions already known for the same
+                        date are kept.
+
+Service options:
+  --listen=<ADDR>       Address to serve on: either `host:port` or the path
+                        of a Unix socket. [default: 127.0.0.1:8411]
+  --refresh=<SECS>      How often to refresh versions. [default: 3600]
+  --server=<ADDR>       Ask the decrepit server at this address.
+
+Network options:
+  --deadline=<SECS>     Give up on any lookups that haven't finished after
+                        this long, and report whatever has.  Exits with
+                        status 3 if anything timed out.
+  --hedge               If a request is taking longer than most of those for
+                        the same distro have (the 95th percentile), send it
+                        again and use whichever answer arrives first.
+  -j, --jobs=<N>        Number of lookups to run at once. [default: 8]
+  --mirror=<URL>        Fetch `scheme://host/path` as `<URL>/host/path`
+                        instead.  Mostly useful for testing.
+  --record=<DIR>        Save every response to an archive in this directory.
+  --replay=<DIR>        Answer every request from an archive made with
+                        `--record`, without using the network at all.
+  --retries=<N>         Retry requests that fail with a connection error or
+                        a server error this many times. [default: 2]
+  --per-host=<N>        Maximum number of connections to any one host.
+                        [default: 2]
+  --timeout=<SECS>      Time limit for looking up each distro.  Can also be
+                        a comma-separated list of `name:secs` overrides.
+                        [default: 30]
+
+Cache options:
+  --cache-dir=<PATH>    Directory for cached pages.  Defaults to a
+                        `decrepit-cache` directory in the system temp dir.
+  --cache-size=<MB>     Maximum size of the cache in megabytes. [default: 128]
+  --cache-ttl=<SECS>    Use cached pages younger than this without asking the
+                        server if they've changed. [default: 300]
+  --fresh               Look every version up again, even if it was looked up
+                        recently.
+  --no-cache            Don't read or write cached pages.
+  --state-dir=<PATH>    Directory for lookup statistics and other state that
+                        should outlive the cache.  Defaults to `~/.decrepit`.
 """
 
 __author__ = "Daniel Keep"
@@ -200,69 +286,265 @@ PROFILES = [
     },
 ]
 
-# Distros that take more than ~5 seconds
-SLOW_DISTROS = {'nixos'}
+# Where to cache downloaded pages.  `None` means "pick a default", `False`
+# disables the cache entirely.
+CACHE_DIR = None
+
+# How long (in seconds) a cached page is used without revalidating it.
+CACHE_TTL = 300
+
+# Rough upper limit on the size of the cache, in bytes.
+CACHE_MAX_BYTES = 128*1024*1024
+
+# Where to keep state that should outlive the cache, like lookup metrics.
+# `None` means `~/.decrepit`.
+STATE_DIR = None
+
+# How many lookups to keep metrics for, per distro and package.
+METRICS_KEEP = 500
+
+# Number of lookups to run at once, and the most connections we'll have open
+# to any one host.
+JOBS = 8
+PER_HOST = 2
+
+# If set, a URL prefix that every request is redirected to.  See `mirror_url`.
+MIRROR = None
+
+# How many times to retry a request that fails with a connection error or
+# one of `RETRY_STATUSES`, and the delay (in seconds) before the first retry.
+# The delay doubles for each retry after that, and is jittered.
+RETRIES = 2
+RETRY_BACKOFF = 0.5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# After this many requests in a row to a host fail, stop sending it requests
+# for `BREAKER_COOLDOWN` seconds.  See `CircuitBreaker`.
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30
+
+# Whether to send a second copy of requests that are slower than usual.  See
+# `ConnectionPool.hedged_request`.
+HEDGE = False
+
+# Directories to record responses to, or replay them from.  See `Archive`.
+RECORD_DIR = None
+REPLAY_DIR = None
+
+# Time limits (in seconds) for looking up a single distro, and for all of them
+# together.  `None` means no limit.
+LOOKUP_TIMEOUT = 30
+DEADLINE = None
+
+# Per-distro overrides for `LOOKUP_TIMEOUT`.  Aliases use the limit of the
+# distro they refer to unless they have their own.
+DISTRO_TIMEOUTS = {
+    'nixos': 120,
+}
+
+# How long to wait for a decrepit server to answer, in seconds.
+SERVER_TIMEOUT = 60
+
+# How many past lookups of a distro `--fast` needs before it will decide that
+# the distro is too slow to check.
+FAST_MIN_SAMPLES = 3
+
+# How long (in seconds) `--fast` goes without looking up a slow distro.  Once
+# the distro's last recorded lookup is older than this, it's looked up again
+# anyway, which also tells us whether it's still slow.
+FAST_REPROBE = 24 * 3600
+
+# How long (in seconds) a looked-up version is used for before it's looked up
+# again.  Rolling releases change often; fixed releases hardly ever do.  Set
+# `USE_RESULTS` to `False` to always look versions up.  See `ResultCache`.
+USE_RESULTS = True
+RESULT_TTL = 24 * 3600
+RESULT_TTL_ROLLING = 3600
+
+# Per-distro overrides for the result TTLs, used the same way as
+# `DISTRO_TIMEOUTS`.
+RESULT_TTLS = {
+    'debian-testing': 3600,
+    'debian-unstable': 3600,
+}
+
+# The package looked up when `--package` isn't given.
+DEFAULT_PACKAGE = 'rust'
+
+# NixOS packages to pull out of the (huge) package metadata and keep in a
+# small index alongside the cached copy.  Should cover everything in the
+# `nixos` packages below, so the index only has to be built once.
+NIXOS_INDEX_PACKAGES = ['rustc', 'cargo', 'llvm']
 
 # How to look up package versions for different distros.
+#
+# Scraped pages are given as a `url`, an `xpath` to evaluate over the whole
+# page, and a regex `re` to pull the `version` out of the result.  If a `tag`
+# is given, the page is instead parsed incrementally and the regex is matched
+# against the text of each element with that tag as soon as it's parsed; the
+# rest of the page is skipped once there's a match.
+#
+# `packages` maps the packages decrepit knows about to the distro's name for
+# them, which is substituted for `{package}` in the `url` and `xpath`.
+# Functions are given as a `func` taking the release and the package name.
 DISTROS = {
     'arch': {
-        'url': 'https://www.archlinux.org/packages/community/x86_64/rust/',
+        'url': 'https://www.archlinux.org/packages/{package}/',
+        'packages': {
+            'rust': 'community/x86_64/rust',
+            'cargo': 'community/x86_64/cargo',
+            'llvm': 'extra/x86_64/llvm',
+        },
         'xpath': r'//h2/text()',
-        're': r'rust \d+:(?P<version>\d+[.]\d+[.]\d+)',
+        'tag': 'h2',
+        're': r'\S+ (\d+:)?(?P<version>\d+[.]\d+[.]\d+)',
     },
     'debian': {
-        'url': 'https://packages.debian.org/{release}/rustc',
+        'url': 'https://packages.debian.org/{release}/{package}',
+        'packages': {
+            'rust': 'rustc',
+            'cargo': 'cargo',
+            'llvm': 'llvm',
+            'rust-src': 'rust-src',
+        },
         'xpath': r'//h1/text()',
-        're': r'rustc [(](?P<version>\d+[.]\d+[.]\d+)',
+        'tag': 'h1',
+        're': r'\S+ [(](\d+:)?(?P<version>\d+[.]\d+[.]\d+)',
     },
     'debian-latest': 'debian',
     'debian-testing': 'debian',
     'debian-unstable': 'debian',
-    'fedora': lambda source: get_fedora(source),
+    'fedora': {
+        'func': lambda source, package: get_fedora(source, package),
+        # `rust-src` is built from the `rust` source package.
+        'packages': {'rust': 'rust', 'cargo': 'cargo', 'llvm': 'llvm', 'rust-src': 'rust'},
+    },
     'fedora-latest': 'fedora',
-    'freebsd': lambda source: get_freebsd(source),
+    'freebsd': {
+        'func': lambda source, package: get_freebsd(source, package),
+        'packages': {'rust': 'lang/rust'},
+    },
     'freebsd-latest': 'freebsd',
-    'nixos': lambda source: get_nixos(source),
-    'openbsd': lambda source: get_openbsd(source),
+    'nixos': {
+        'func': lambda source, package: get_nixos(source, package),
+        'packages': {'rust': 'rustc', 'cargo': 'cargo', 'llvm': 'llvm'},
+    },
+    'openbsd': {
+        'func': lambda source, package: get_openbsd(source, package),
+        'packages': {'rust': 'lang/rust'},
+    },
     'openbsd-latest': 'openbsd',
     'opensuse': {
-        'url': 'https://build.opensuse.org/package/view_file/openSUSE:Leap:{release}/rust/rust.spec?expand=1',
+        'url': 'https://build.opensuse.org/package/view_file/openSUSE:Leap:{release}/{package}/{package}.spec?expand=1',
+        'packages': {'rust': 'rust', 'cargo': 'cargo', 'llvm': 'llvm', 'rust-src': 'rust'},
         'xpath': r'//pre/text()',
+        'tag': 'pre',
         're': r'Version:\s+(?P<version>\d+[.]\d+[.]\d+)',
     },
     'opensuse-latest': 'opensuse',
     'ubuntu': {
-        'url': 'http://packages.ubuntu.com/{release}/rustc',
+        'url': 'http://packages.ubuntu.com/{release}/{package}',
         'inherit': 'debian',
     },
     'ubuntu-latest': 'ubuntu',
 }
 
 
+# Only cheap modules are imported here.  The heavier ones (`lxml`,
+# `tabulate`, `http.client`, `concurrent.futures`, ...) are imported by the
+# code that needs them, so that `-l` and answers from the cache don't pay to
+# load them.  `bench-decrepit.py --startup` keeps an eye on this.
+import codecs
+import collections
 import datetime
 import docopt
-import gzip
+import glob
+import hashlib
+import io
 import json
-import lxml.html
+import math
+import os
 import os.path
 import re
-import tempfile
-import urllib.request
-from concurrent.futures import ThreadPoolExecutor
+import sys
+import threading
+import time
+import urllib.parse
+import zlib
+from contextlib import closing
 from itertools import chain
-from tabulate import tabulate
 
 
 RE_VER = re.compile(r'(?P<ma>\d+)[.](?P<mi>\d+)([.](?P<re>\d+))')
 VERBOSE = False
 
+# Stands in for the version of a lookup that ran out of time.  Sorts after
+# every real version.
+TIMED_OUT = (float('inf'),) * 3
+
+# Per-thread state: the deadline, metrics and `SingleFlight` of the lookup
+# being run.
+_LOCAL = threading.local()
 
-def main(args):
+
+def main(argv):
     # Parse args.
-    args = docopt.docopt(__doc__, argv=args[1:], version='decrepit '+__version__)
+    args = docopt.docopt(__doc__, argv=argv[1:], version='decrepit '+__version__)
     set_verbose(args['--verbose'])
     trace('Arguments: %r' % args)
 
+    set_cache(
+        path = False if args['--no-cache'] else args['--cache-dir'],
+        ttl = float(args['--cache-ttl']),
+        max_bytes = int(float(args['--cache-size'])*1024*1024),
+        results = not args['--fresh'],
+    )
+    set_network(
+        jobs = int(args['--jobs']),
+        per_host = int(args['--per-host']),
+        mirror = args['--mirror'],
+        retries = int(args['--retries']),
+        hedge = args['--hedge'],
+    )
+    set_archive(
+        record = args['--record'],
+        replay = args['--replay'],
+    )
+    set_state_dir(args['--state-dir'])
+    set_timeouts(
+        deadline = float(args['--deadline']) if args['--deadline'] else None,
+        timeouts = args['--timeout'],
+    )
+
+    if args['--serve']:
+        return serve(args['--listen'], float(args['--refresh']))
+
+    if args['--stats']:
+        return show_stats(args, sys.stdout)
+
+    if args['--export']:
+        return export_history(args['--export'])
+
+    if args['--import']:
+        return import_history(args['--import'])
+
+    server = args['--server'] or os.environ.get('DECREPIT_SERVER')
+    local = local_options(args)
+    if server and local:
+        trace('not asking the server, as it would ignore %s' % ', '.join(local))
+    elif server:
+        r = query_server(server, argv[1:])
+        if r is not None:
+            return r
+
+    return run_query(args, sys.stdout)
+
+
+def run_query(args, out):
+    """
+    Answer the query described by the (already parsed) arguments, writing the
+    result to `out`.  Returns the exit status.
+    """
     as_of_date = parse_date(args['DATE'])
     distro_strs = args['--distro']
     fast_only = args['--fast']
@@ -284,35 +566,23 @@ def main(args):
     distros = list(distros)
 
     if len(distros) == 0:
-        distros = list(DISTROS.keys())
+        distros = list(SCRAPERS.keys())
 
     trace('distros: %r' % distros)
 
-    # Find the right profile
-    profiles = sorted(
-        (p for p in PROFILES if p['date'] <= as_of_date),
-        key = lambda p: p['date'],
-        reverse = True,
-    )
+    if args['--from'] is not None:
+        return main_range(args, distros, distro_strs, tablefmt, table_esc, out)
 
-    if len(profiles) == 0:
-        print('error: provided date `%s` is too old: no data available.' % as_of_date)
+    # Find the right profile
+    profile = find_profile(as_of_date)
+    if profile is None:
+        print('error: provided date `%s` is too old: no data available.' % as_of_date, file=out)
         return 1
 
-    profile = profiles[0]
     trace('Profile: %r' % profile)
 
     # Allow overriding of distro args
-    releases = profile['releases'].copy()
-    for distro_str in distro_strs:
-        releases.update({
-            d:a
-            for (d, a)
-            in ((d.split(':', 1) + [''])[:2]
-                for d
-                in distro_str.split(','))
-            if a.strip() is not ''
-        })
+    releases = override_releases(profile['releases'], distro_strs)
     trace('releases: %r' % releases)
 
     # List distros?
@@ -323,33 +593,29 @@ def main(args):
             for (d, a)
             in sorted(releases.items(), key = lambda da: da[1])
         )
-        print(', '.join(distros))
+        print(', '.join(distros), file=out)
         return 0
 
     # Resolve the package versions
-    def check(distro):
-        if fast_only and distro in SLOW_DISTROS:
-            return False
-        return distro in distros
-
-    def dispatch(da):
-        distro, arg = da
-        start_at = datetime.datetime.now()
-        v = get_dispatch(distro, arg)
-        secs = (datetime.datetime.now() - start_at).total_seconds()
-        trace('get_dispatch(%r, %r): took %r seconds' % (distro, arg, secs))
-        return (distro, v)
-
-    trace('getting package versions...')
-    start_at = datetime.datetime.now()
-    pkg_vers = list(ThreadPoolExecutor().map(
-        dispatch,
-        (da for da in releases.items() if check(da[0]))
-    ))
-    took_secs = (datetime.datetime.now() - start_at).total_seconds()
-    trace('took %r seconds overall' % took_secs)
+    lookups = [da for da in releases.items() if da[0] in distros]
+    if len(args['--package']) > 0:
+        return main_packages(args, lookups, as_of_date, tablefmt, table_esc, out)
+    hist = history_versions(lookups, as_of_date)
+    fetch = [da for da in lookups if da not in hist]
+    stale = {}
+    if fast_only:
+        fetch, stale = plan_lookups(fetch, float(args['--budget']))
+    vers = get_versions(fetch)
+    vers.update(stale)
+    vers.update(hist)
+    pkg_vers = [(d, vers[(d, a)]) for (d, a) in lookups]
+    stale_distros = {d for (d, _) in stale}
     trace('pkg_vers: %r' % pkg_vers)
 
+    timed_out = sorted(d for (d, v) in pkg_vers if v == TIMED_OUT)
+    if len(timed_out) > 0:
+        trace('timed out: %s' % ', '.join(timed_out))
+
     pkg_vers = [
         (d, fmt_ver(v))
         for (d, v)
@@ -357,7 +623,7 @@ def main(args):
     ]
 
     if len(pkg_vers) == 0:
-        print('error: no packages found!')
+        print('error: no packages found!', file=out)
         return 2
 
     # Output.
@@ -369,20 +635,1329 @@ def main(args):
             table_headers=['Distro', 'Release', 'Version']
 
         if show_json:
-            pkg_vers = [
-                {h.lower(): f for (f, h) in zip(pkg_ver, table_headers)}
-                for pkg_ver
-                in pkg_vers
-            ]
-            print(json.dumps(pkg_vers, sort_keys=True))
+            rows = []
+            for pkg_ver in pkg_vers:
+                row = {h.lower(): f for (f, h) in zip(pkg_ver, table_headers)}
+                if pkg_ver[0] in stale_distros:
+                    row['stale'] = True
+                rows.append(row)
+            print(json.dumps(rows, sort_keys=True), file=out)
 
         else:
+            pkg_vers = [
+                fs[:-1] + (fs[-1] + ' (stale)',) if fs[0] in stale_distros else fs
+                for fs in pkg_vers
+            ]
+            from tabulate import tabulate
             pkg_vers = [tuple(table_esc(f) for f in fs) for fs in pkg_vers]
-            print(tabulate(pkg_vers, headers=table_headers, tablefmt=tablefmt))
+            print(tabulate(pkg_vers, headers=table_headers, tablefmt=tablefmt), file=out)
+
+    else:
+        print(min_version(v for (_, v) in pkg_vers), file=out)
+
+    if len(timed_out) > 0:
+        return 3
+
+
+def main_range(args, distros, distro_strs, tablefmt, table_esc, out):
+    """
+    Report on a range of dates, looking up each distinct release only once.
+    """
+    from_date = parse_date(args['--from'])
+    to_date = parse_date(args['--to'])
+    step = args['--step']
+    show_all = args['--all']
+    show_rel = args['--show-release']
+    show_json = args['--json']
+
+    if step is not None:
+        dates = list(date_range(from_date, to_date, int(step)))
+    else:
+        dates = sorted({from_date} | {
+            p['date'] for p in PROFILES if from_date < p['date'] <= to_date
+        })
+    trace('dates: %r' % dates)
+
+    series = []
+    for date in dates:
+        profile = find_profile(date)
+        if profile is None:
+            trace('no profile for %s; skipping' % date)
+            continue
+        releases = override_releases(profile['releases'], distro_strs)
+        series.append((date, {d: a for (d, a) in releases.items() if d in distros}))
+
+    if len(series) == 0:
+        print('error: provided dates are too old: no data available.', file=out)
+        return 1
 
+    # Past dates are answered from the history where possible.
+    hist = {}
+    for (date, releases) in series:
+        for (da, v) in history_versions(releases.items(), date).items():
+            hist[(date, da)] = v
+
+    lookups = sorted({
+        da
+        for (date, releases) in series
+        for da in releases.items()
+        if (date, da) not in hist
+    })
+    trace('%d unique lookups for %d dates' % (len(lookups), len(series)))
+    stale = {}
+    if args['--fast']:
+        lookups, stale = plan_lookups(lookups, float(args['--budget']))
+    vers = get_versions(lookups)
+    vers.update(stale)
+    status = 3 if TIMED_OUT in vers.values() else None
+
+    rows = []
+    for (date, releases) in series:
+        row_vers = {
+            d: fmt_ver(hist[(date, (d, a))] if (date, (d, a)) in hist else vers[(d, a)])
+            for (d, a) in releases.items()
+        }
+        row_stale = {d for (d, a) in releases.items() if (date, (d, a)) not in hist and (d, a) in stale}
+        rows.append((date, releases, row_vers, row_stale, min_version(row_vers.values())))
+
+    if show_json:
+        entries = []
+        for (date, releases, row_vers, row_stale, min_ver) in rows:
+            entry = {'date': date, 'version': min_ver}
+            if show_all:
+                entry['distros'] = [
+                    dict([('distro', d), ('version', v)]
+                        + ([('release', releases[d])] if show_rel else [])
+                        + ([('stale', True)] if d in row_stale else []))
+                    for (d, v) in sorted(row_vers.items())
+                ]
+            entries.append(entry)
+        print(json.dumps(entries, sort_keys=True), file=out)
+        return status
+
+    if show_all:
+        columns = sorted({d for (_, releases, _, _, _) in rows for d in releases})
+        table_headers = ['Date', 'Version'] + columns
+        table = []
+        for (date, releases, row_vers, row_stale, min_ver) in rows:
+            cells = []
+            for d in columns:
+                if d not in row_vers:
+                    cells.append('')
+                    continue
+                cell = row_vers[d]
+                if show_rel:
+                    cell = '%s (%s)' % (cell, releases[d])
+                if d in row_stale:
+                    cell += ' (stale)'
+                cells.append(cell)
+            table.append(tuple(table_esc(f) for f in [date, min_ver] + cells))
     else:
-        vs = [v for (_, v) in pkg_vers if v != '0.0.0'] + ['unknown']
-        print(vs[0])
+        table_headers = ['Date', 'Version']
+        table = [(date, min_ver) for (date, _, _, _, min_ver) in rows]
+    from tabulate import tabulate
+    print(tabulate(table, headers=table_headers, tablefmt=tablefmt), file=out)
+    return status
+
+
+Result = collections.namedtuple('Result', 'distro release version outcome')
+Result.__doc__ = """
+The result of looking up one distro's version of Rust.  `version` is a
+string such as `'1.22.1'`, or `None` if the lookup failed; `outcome` is one
+of `'ok'`, `'error'` or `'timeout'`.
+"""
+
+# How long `resolve` remembers results for, in seconds.
+MEMO_TTL = 300
+
+_MEMO = None
+_MEMO_LOCK = threading.Lock()
+
+def resolve(date=None, distros=None, releases=None):
+    """
+    Look up which versions of Rust distros ship, for use from Python.
+
+    `date` (a `datetime.date` or `YYYY-MM-DD` string; default today) picks the
+    profile of releases to check, `distros` limits which distros are checked,
+    and `releases` maps distro names to releases to check instead of the
+    profile's.  Returns a list of `Result`s, sorted by distro.
+
+    Past dates are answered from the history where possible.  Other results
+    are remembered for `MEMO_TTL` seconds, so asking again is cheap; failed
+    lookups aren't remembered.  Raises `ValueError` for unknown distros
+    (in `distros` or `releases`), distros with no release to check, and dates
+    before the first profile, and `TypeError` if `distros` is a string rather
+    than a list.  This is safe to call from several threads at once.  The
+    cache, network and timeout settings are the module's; see `set_cache` and
+    friends.
+    """
+    global _MEMO
+    if isinstance(date, datetime.date):
+        date = date.isoformat()
+    as_of_date = parse_date(date)
+    profile = find_profile(as_of_date)
+    if profile is None:
+        raise ValueError('date %r is too old: no data available' % as_of_date)
+
+    if isinstance(distros, str):
+        raise TypeError('distros should be a list of names, not %r' % distros)
+    all_releases = dict(profile['releases'])
+    all_releases.update(releases or {})
+    if distros is None:
+        distros = [d for d in all_releases if d in SCRAPERS]
+    unknown = {d for d in chain(distros, releases or {}) if d not in SCRAPERS}
+    if len(unknown) > 0:
+        raise ValueError('unknown distros: %s' % ', '.join(sorted(unknown)))
+    unknown = [d for d in distros if d not in all_releases]
+    if len(unknown) > 0:
+        raise ValueError('no release known for: %s' % ', '.join(sorted(unknown)))
+
+    with _MEMO_LOCK:
+        if _MEMO is None:
+            _MEMO = WarmResults(ttl=MEMO_TTL)
+    lookups = [(d, all_releases[d]) for d in sorted(set(distros))]
+    vers = history_versions(lookups, as_of_date)
+    vers.update(_MEMO.get([da for da in lookups if da not in vers]))
+
+    results = []
+    for (distro, release) in lookups:
+        ver = vers[(distro, release)]
+        outcome = lookup_outcome(ver)
+        results.append(Result(
+            distro = distro,
+            release = release,
+            version = fmt_ver(ver) if outcome == 'ok' else None,
+            outcome = outcome,
+        ))
+    return results
+
+
+def main_packages(args, lookups, as_of_date, tablefmt, table_esc, out):
+    """
+    Show the versions of several packages.
+    """
+    show_all = args['--all']
+    show_rel = args['--show-release']
+    show_json = args['--json']
+
+    packages = list(dict.fromkeys(args['--package']))
+    pkg_lookups = [
+        (d, a, p)
+        for (d, a) in lookups
+        for p in packages
+        if d in SCRAPERS and p in SCRAPERS[d].packages
+    ]
+    if len(pkg_lookups) == 0:
+        print('error: no packages found!', file=out)
+        return 2
+    hist = history_versions(pkg_lookups, as_of_date)
+    fetch = [da for da in pkg_lookups if da not in hist]
+    stale = {}
+    if args['--fast']:
+        fetch, stale = plan_lookups(fetch, float(args['--budget']))
+    vers = get_versions(fetch)
+    vers.update(stale)
+    vers.update(hist)
+    status = 3 if TIMED_OUT in vers.values() else None
+
+    if not show_all:
+        min_vers = [
+            (p, min_version(fmt_ver(v) for ((_, _, vp), v) in vers.items() if vp == p))
+            for p in packages
+        ]
+        from tabulate import tabulate
+        table = [tuple(table_esc(f) for f in row) for row in min_vers]
+        print(tabulate(table, headers=['Package', 'Version'], tablefmt=tablefmt), file=out)
+        return status
+
+    rows = []
+    for (d, a) in sorted(lookups):
+        cells = [fmt_ver(vers[(d, a, p)]) if (d, a, p) in vers else None for p in packages]
+        if all(c is None for c in cells):
+            continue
+        stale_pkgs = [p for p in packages if (d, a, p) in stale]
+        rows.append((d, a, cells, stale_pkgs))
+
+    if show_json:
+        entries = [
+            dict([('distro', d)]
+                + ([('release', a)] if show_rel else [])
+                + [('packages', {p: c for (p, c) in zip(packages, cells) if c is not None})]
+                + ([('stale', stale_pkgs)] if stale_pkgs else []))
+            for (d, a, cells, stale_pkgs) in rows
+        ]
+        print(json.dumps(entries, sort_keys=True), file=out)
+    else:
+        from tabulate import tabulate
+        table_headers = ['Distro'] + (['Release'] if show_rel else []) + packages
+        table = [
+            tuple(table_esc(f) for f in [d] + ([a] if show_rel else []) + [
+                '-' if c is None else c + ' (stale)' if p in stale_pkgs else c
+                for (p, c) in zip(packages, cells)
+            ])
+            for (d, a, cells, stale_pkgs) in rows
+        ]
+        print(tabulate(table, headers=table_headers, tablefmt=tablefmt), file=out)
+    return status
+
+
+def find_profile(as_of_date):
+    """
+    Find the most recent profile not newer than the given date.
+    """
+    profiles = sorted(
+        (p for p in PROFILES if p['date'] <= as_of_date),
+        key = lambda p: p['date'],
+        reverse = True,
+    )
+    return profiles[0] if len(profiles) > 0 else None
+
+
+def override_releases(releases, distro_strs):
+    """
+    Apply `name:release` overrides from `--distro` arguments.
+    """
+    releases = releases.copy()
+    for distro_str in distro_strs:
+        releases.update({
+            d:a
+            for (d, a)
+            in ((d.split(':', 1) + [''])[:2]
+                for d
+                in distro_str.split(','))
+            if a.strip() is not ''
+        })
+    return releases
+
+
+def history_versions(lookups, as_of_date):
+    """
+    Look up the versions for some lookups as of a past date in the history.
+    Returns a dict of whichever could be found there.  Today and later aren't
+    answered from the history.
+    """
+    if as_of_date >= parse_date(None):
+        return {}
+    vers = get_history().lookup(lookups, as_of_date)
+    trace('%d of %d lookups answered from history' % (len(vers), len(list(lookups))))
+    return vers
+
+
+def get_versions(lookups):
+    """
+    Look up the versions for a collection of `(distro, release)` pairs.
+    Returns a dict keyed by those pairs.
+
+    Uses the warm results when running as a server.
+    """
+    if _WARM is not None:
+        return _WARM.get(lookups)
+    return fetch_versions(lookups)
+
+
+def fetch_versions(lookups, fresh=False):
+    """
+    Look up the versions for a collection of `(distro, release)` pairs in
+    parallel.  Returns a dict keyed by those pairs; each distinct pair is only
+    looked up once.  `(distro, release, package)` triples look up a package
+    other than `DEFAULT_PACKAGE`.
+
+    Lookups that don't finish within their time limit, or before `DEADLINE`,
+    come back as `TIMED_OUT`.
+
+    Lookups in the same call share any work they have in common; see
+    `single_flight`.  Versions looked up recently enough are reused rather
+    than looked up again, unless `fresh` is set or `USE_RESULTS` isn't; see
+    `ResultCache`.  Recording and replaying never use or save results, since
+    they have to go through `urlopen`.
+    """
+    import concurrent.futures
+    start_at = datetime.datetime.now()
+    overall_deadline = None if DEADLINE is None else time.time() + DEADLINE
+
+    records = []
+    flights = SingleFlight()
+    hedge_delays = get_hedge_delays() if HEDGE else {}
+
+    def dispatch(da):
+        distro, arg = da[:2]
+        package = da[2] if len(da) > 2 else DEFAULT_PACKAGE
+        start_at = datetime.datetime.now()
+        _LOCAL.deadline = min(
+            (d for d in (overall_deadline, lookup_deadline(distro)) if d is not None),
+            default = None,
+        )
+        _LOCAL.metrics = {}
+        _LOCAL.flights = flights
+        _LOCAL.hedge_after = hedge_delays.get((distro, package))
+        try:
+            v = get_dispatch(*da)
+        finally:
+            _LOCAL.deadline = None
+            _LOCAL.flights = None
+            _LOCAL.hedge_after = None
+            metrics, _LOCAL.metrics = _LOCAL.metrics, None
+        secs = (datetime.datetime.now() - start_at).total_seconds()
+        trace('get_dispatch%r: took %r seconds' % (da, secs))
+        records.append(metrics_record(distro, arg, package, v, secs, metrics))
+        return v
+
+    lookups = list(dict.fromkeys(lookups))
+    cached = {}
+    if USE_RESULTS and not fresh and RECORD_DIR is None and REPLAY_DIR is None:
+        cached = get_results().get(lookups, fresh_only=True)
+        for da in cached:
+            trace('get_dispatch%r: using result from %s' % (da, get_results().path))
+    trace('getting package versions...')
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=JOBS)
+    futures = {da: executor.submit(dispatch, da) for da in lookups if da not in cached}
+    wait_secs = None
+    if overall_deadline is not None:
+        wait_secs = max(0, overall_deadline - time.time())
+    concurrent.futures.wait(futures.values(), timeout=wait_secs)
+
+    vers = {}
+    for (da, future) in futures.items():
+        if future.done():
+            vers[da] = future.result()
+        else:
+            trace('get_dispatch%r: missed the deadline' % (da,))
+            future.cancel()
+            vers[da] = TIMED_OUT
+            secs = (datetime.datetime.now() - start_at).total_seconds()
+            package = da[2] if len(da) > 2 else DEFAULT_PACKAGE
+            records.append(metrics_record(da[0], da[1], package, TIMED_OUT, secs, {}))
+    # Anything still running will give up at its own deadline; don't wait.
+    executor.shutdown(wait=False)
+
+    took_secs = (datetime.datetime.now() - start_at).total_seconds()
+    trace('took %r seconds overall' % took_secs)
+    # A replay says nothing about how distros behave or what they ship today.
+    if REPLAY_DIR is None:
+        get_metrics().append(list(records))
+    good = {
+        da: v
+        for (da, v) in vers.items()
+        if v not in (parse_semver('0.0.0'), TIMED_OUT)
+    }
+    if REPLAY_DIR is None:
+        get_results().update(good)
+        get_history().record(parse_date(None), good)
+    vers.update(cached)
+    return vers
+
+
+def plan_lookups(lookups, budget):
+    """
+    Work out which lookups can be expected to finish within `budget` seconds,
+    going by the recorded metrics.  Returns `(fetch, stale)`: the lookups to
+    do, and a dict of the last known good versions for the rest.
+
+    Lookups with a fresh result are left to `fetch_versions`, which will use
+    it.  Lookups which haven't succeeded before are always done, as are
+    lookups of distros not looked up for `FAST_REPROBE`, and everything when
+    recording or replaying.
+    """
+    if RECORD_DIR is not None or REPLAY_DIR is not None:
+        return (list(lookups), {})
+    records = [r for r in get_metrics().load() if r.get('outcome') != 'error']
+    stats = {}
+    last_good = get_results().get(lookups, fresh_only=False)
+    fresh = get_results().get(lookups, fresh_only=True) if USE_RESULTS else {}
+    fetch = []
+    stale = {}
+    for da in lookups:
+        package = da[2] if len(da) > 2 else DEFAULT_PACKAGE
+        if package not in stats:
+            stats[package] = distro_stats(records, package)
+        st = stats[package].get(da[0])
+        slow = (st is not None
+            and st['count'] >= FAST_MIN_SAMPLES
+            and st['p95'] > budget
+            and time.time() - st['last_at'] < FAST_REPROBE)
+        if slow and da in last_good and da not in fresh:
+            trace('%s usually takes %.1fs; using last known version' % (da[0], st['p95']))
+            stale[da] = last_good[da]
+        else:
+            fetch.append(da)
+    return (fetch, stale)
+
+
+_RESULTS = None
+_RESULTS_LOCK = threading.Lock()
+
+def get_results():
+    """
+    Returns the process-wide `ResultCache`.
+    """
+    global _RESULTS
+    path = os.path.join(get_state_dir(), 'results.json')
+    with _RESULTS_LOCK:
+        if _RESULTS is None or _RESULTS.path != path:
+            _RESULTS = ResultCache(path)
+        return _RESULTS
+
+
+def get_history():
+    return History(os.path.join(get_state_dir(), 'history.sqlite3'))
+
+
+def export_history(path):
+    """
+    Write the version history to a file, or stdout if `path` is `-`.
+    """
+    try:
+        if path == '-':
+            n = get_history().dump(sys.stdout)
+        else:
+            with open(path, 'w', encoding='utf-8') as f:
+                n = get_history().dump(f)
+    except OSError as e:
+        print('error: could not export to %s: %s' % (path, e), file=sys.stderr)
+        return 1
+    trace('exported %d versions' % n)
+    return 0
+
+
+def import_history(paths):
+    """
+    Add the versions in files written by `export_history` to the history.
+    """
+    history = get_history()
+    for path in paths:
+        try:
+            if path == '-':
+                n = history.load(sys.stdin)
+            else:
+                with open(path, 'r', encoding='utf-8') as f:
+                    n = history.load(f)
+        except (OSError, ValueError, KeyError) as e:
+            print('error: could not import %s: %s' % (path, e), file=sys.stderr)
+            return 1
+        trace('imported %d new versions from %s' % (n, path))
+    return 0
+
+
+class History:
+    """
+    Every version that has been looked up, and the date it was looked up on,
+    kept in an SQLite database.  Since the scrapers can only see what distros
+    ship now, this is the only way to know what they shipped in the past.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS versions (
+            date TEXT NOT NULL,
+            distro TEXT NOT NULL,
+            release TEXT NOT NULL,
+            package TEXT NOT NULL,
+            version TEXT NOT NULL,
+            PRIMARY KEY (distro, release, package, date)
+        )
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self):
+        import sqlite3
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute(self.SCHEMA)
+        return conn
+
+    def record(self, date, vers):
+        """
+        Remember the versions looked up on `date`, replacing any others
+        looked up earlier the same day.
+        """
+        import sqlite3
+        if len(vers) == 0:
+            return
+        rows = [
+            (date, da[0], da[1], da[2] if len(da) > 2 else DEFAULT_PACKAGE, fmt_ver(v))
+            for (da, v) in vers.items()
+        ]
+        try:
+            with closing(self.connect()) as conn, conn:
+                conn.executemany('INSERT OR REPLACE INTO versions VALUES (?, ?, ?, ?, ?)', rows)
+        except (OSError, sqlite3.Error) as e:
+            trace('could not save version history: %s' % e)
+
+    def lookup(self, lookups, as_of_date):
+        """
+        Returns the most recent version known on or before `as_of_date` for
+        each lookup that has one.
+        """
+        import sqlite3
+        if not os.path.exists(self.path):
+            return {}
+        vers = {}
+        try:
+            with closing(self.connect()) as conn:
+                for da in lookups:
+                    package = da[2] if len(da) > 2 else DEFAULT_PACKAGE
+                    row = conn.execute(
+                        'SELECT version FROM versions'
+                        ' WHERE distro = ? AND release = ? AND package = ? AND date <= ?'
+                        ' ORDER BY date DESC LIMIT 1',
+                        (da[0], da[1], package, as_of_date),
+                    ).fetchone()
+                    if row is not None:
+                        vers[da] = parse_semver(row[0])
+        except (OSError, sqlite3.Error) as e:
+            trace('could not read version history: %s' % e)
+        return vers
+
+    def dump(self, f):
+        """
+        Write the history to a file as JSON lines, returning how many there
+        were.
+        """
+        n = 0
+        with closing(self.connect()) as conn:
+            rows = conn.execute(
+                'SELECT date, distro, release, package, version FROM versions'
+                ' ORDER BY date, distro, release, package')
+            for (date, distro, release, package, version) in rows:
+                f.write(json.dumps({
+                    'date': date,
+                    'distro': distro,
+                    'release': release,
+                    'package': package,
+                    'version': version,
+                }, sort_keys=True) + '\n')
+                n += 1
+        return n
+
+    def load(self, f):
+        """
+        Add versions written by `dump`, keeping any already known for the same
+        date.  Returns how many were added.
+        """
+        rows = []
+        for line in f:
+            if line.strip():
+                r = json.loads(line)
+                if RE_VER.match(r['version']) is None:
+                    raise ValueError('bad version: %r' % r['version'])
+                rows.append((parse_date(r['date']), r['distro'], r['release'],
+                    r.get('package', DEFAULT_PACKAGE), fmt_ver(parse_semver(r['version']))))
+        with closing(self.connect()) as conn, conn:
+            before = conn.total_changes
+            conn.executemany('INSERT OR IGNORE INTO versions VALUES (?, ?, ?, ?, ?)', rows)
+            return conn.total_changes - before
+
+
+class ResultCache:
+    """
+    The most recent version successfully looked up for each `(distro,
+    release, package)`, with when it was looked up and a hash of the
+    definition of the scraper that found it, kept as a JSON file.
+
+    Fresh results (see `result_ttl`) are used instead of looking versions up
+    again, and `--fast` uses results of any age.  Results found with a
+    different scraper definition are never used.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = None
+
+    @staticmethod
+    def key(da):
+        return (da[0], da[1], da[2] if len(da) > 2 else DEFAULT_PACKAGE)
+
+    def read_entries(self):
+        try:
+            with open(self.path, 'rb') as f:
+                entries = json.loads(f.read().decode('utf-8'))
+        except (OSError, ValueError):
+            return {}
+        return {
+            (e['distro'], e['release'], e.get('package', DEFAULT_PACKAGE)): e
+            for e in entries
+        }
+
+    def get(self, lookups, fresh_only):
+        """
+        Returns the known versions for any of the lookups, optionally only
+        those still fresh.
+        """
+        with self.lock:
+            if self.entries is None:
+                self.entries = self.read_entries()
+            entries = self.entries
+        now = time.time()
+        vers = {}
+        for da in lookups:
+            e = entries.get(self.key(da))
+            scraper = SCRAPERS.get(da[0])
+            if e is None or scraper is None or e.get('definition') != scraper.definition_hash():
+                continue
+            if fresh_only and now - e['at'] >= result_ttl(da[0], da[1]):
+                continue
+            vers[da] = tuple(e['version'])
+        return vers
+
+    def update(self, vers):
+        if len(vers) == 0:
+            return
+        now = time.time()
+        with self.lock:
+            # Pick up anything other processes have saved in the meantime.
+            entries = self.read_entries()
+            for (da, ver) in vers.items():
+                (distro, release, package) = self.key(da)
+                scraper = SCRAPERS.get(distro)
+                entries[(distro, release, package)] = {
+                    'distro': distro,
+                    'release': release,
+                    'package': package,
+                    'version': list(ver),
+                    'at': now,
+                    'definition': scraper.definition_hash() if scraper is not None else None,
+                }
+            self.entries = entries
+            data = json.dumps(sorted(entries.values(),
+                key=lambda e: (e['distro'], e['release'], e['package'])))
+            try:
+                write_atomic(self.path, data.encode('utf-8'))
+            except OSError as e:
+                trace('could not save results: %s' % e)
+
+
+def write_atomic(path, data):
+    """
+    Write a file by writing a temporary file next to it and renaming that into
+    place, so that nothing ever sees it half-written.  `data` is either bytes
+    or an iterable of chunks of bytes.
+    """
+    import tempfile
+    if isinstance(data, bytes):
+        data = [data]
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in data:
+                f.write(chunk)
+        os.replace(tmp_path, path)
+    except:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def get_hedge_delays():
+    """
+    Work out how long to wait for a response before hedging, for each distro
+    and package: the 95th percentile of the time to first byte of its past
+    requests.  Those without enough history aren't hedged.
+    """
+    by_lookup = {}
+    for r in get_metrics().load():
+        if r.get('outcome') == 'ok' and r.get('requests', 0) > 0:
+            key = (r['distro'], r.get('package', DEFAULT_PACKAGE))
+            by_lookup.setdefault(key, []).append(r['first_byte_secs'] / r['requests'])
+    return {
+        key: percentile(secs, 95)
+        for (key, secs) in by_lookup.items()
+        if len(secs) >= FAST_MIN_SAMPLES
+    }
+
+
+def add_metric(name, amount):
+    """
+    Add to one of the current lookup's metrics, if it's being measured.
+    """
+    metrics = getattr(_LOCAL, 'metrics', None)
+    if metrics is not None:
+        metrics[name] = metrics.get(name, 0) + amount
+
+
+def lookup_outcome(ver):
+    """
+    Classify a looked-up version as `'ok'`, `'error'` or `'timeout'`.
+    """
+    if ver == TIMED_OUT:
+        return 'timeout'
+    elif ver == parse_semver('0.0.0'):
+        return 'error'
+    return 'ok'
+
+
+def metrics_record(distro, release, package, ver, secs, metrics):
+    network_secs = sum(metrics.get(k, 0) for k in ('connect', 'first_byte', 'download'))
+    return {
+        'at': time.time(),
+        'distro': distro,
+        'release': release,
+        'package': package,
+        'outcome': lookup_outcome(ver),
+        'secs': secs,
+        'connect_secs': metrics.get('connect', 0),
+        'first_byte_secs': metrics.get('first_byte', 0),
+        'download_secs': metrics.get('download', 0),
+        'bytes': metrics.get('bytes', 0),
+        'parse_secs': max(0, secs - network_secs),
+        'requests': metrics.get('requests', 0),
+        'retries': metrics.get('retries', 0),
+        'hedges': metrics.get('hedges', 0),
+    }
+
+
+def get_state_dir():
+    if STATE_DIR is not None:
+        return STATE_DIR
+    return os.path.join(os.path.expanduser('~'), '.decrepit')
+
+
+def get_metrics():
+    return MetricsStore(os.path.join(get_state_dir(), 'metrics.jsonl'))
+
+
+def get_makefile_versions():
+    return MakefileVersions(os.path.join(get_state_dir(), 'makefile-versions.json'))
+
+
+class MakefileVersions:
+    """
+    The versions found in port Makefiles, keyed by the URL of a particular
+    revision of the Makefile, kept as a JSON file.  A revision never changes,
+    so neither do these.  See `get_port_makefile`.
+    """
+    # Lookups run in threads; don't let them lose each other's updates.
+    lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                return json.loads(f.read().decode('utf-8'))
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, url):
+        ver = self.load().get(url)
+        return tuple(ver) if ver is not None else None
+
+    def update(self, url, ver):
+        with self.lock:
+            versions = self.load()
+            if versions.get(url) == list(ver):
+                return
+            versions[url] = list(ver)
+            try:
+                write_atomic(self.path, json.dumps(versions, sort_keys=True).encode('utf-8'))
+            except OSError as e:
+                trace('could not save Makefile versions: %s' % e)
+
+
+class MetricsStore:
+    """
+    Per-lookup metrics, kept as a file of JSON lines.
+
+    Each run appends its records in a single write so that concurrent runs
+    don't interleave.  Once the file holds a lot more than `METRICS_KEEP`
+    records per distro, it's rewritten with just the most recent ones; a run
+    which appends at the same moment may lose its records, which is fine for
+    statistics.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def append(self, records):
+        if len(records) == 0:
+            return
+        data = ''.join(json.dumps(r, sort_keys=True) + '\n' for r in records)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'ab') as f:
+                f.write(data.encode('utf-8'))
+            self.trim()
+        except OSError as e:
+            trace('could not save metrics: %s' % e)
+
+    def load(self):
+        records = []
+        try:
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line.decode('utf-8')))
+                    except ValueError:
+                        continue
+        except OSError:
+            pass
+        return records
+
+    def trim(self):
+        # Only bother once there's a good deal of excess.
+        if os.path.getsize(self.path) < 400 * METRICS_KEEP * (len(SCRAPERS) + 1):
+            return
+        by_lookup = {}
+        for r in self.load():
+            key = (r.get('distro'), r.get('package', DEFAULT_PACKAGE))
+            by_lookup.setdefault(key, []).append(r)
+        records = sorted(
+            chain.from_iterable(rs[-METRICS_KEEP:] for rs in by_lookup.values()),
+            key = lambda r: r.get('at', 0),
+        )
+        write_atomic(self.path,
+            ((json.dumps(r, sort_keys=True) + '\n').encode('utf-8') for r in records))
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of some values; `p` is between 0 and 100.
+    """
+    values = sorted(values)
+    if len(values) == 0:
+        return None
+    rank = max(1, int(math.ceil(p / 100.0 * len(values))))
+    return values[rank - 1]
+
+
+def distro_stats(records, package=DEFAULT_PACKAGE):
+    """
+    Summarise metrics records of lookups of `package` by distro.  Records
+    from before the package was recorded are of `DEFAULT_PACKAGE`.
+    """
+    import statistics
+    by_distro = {}
+    for r in records:
+        if r.get('package', DEFAULT_PACKAGE) == package:
+            by_distro.setdefault(r['distro'], []).append(r)
+    stats = {}
+    for (distro, rs) in sorted(by_distro.items()):
+        secs = [r['secs'] for r in rs]
+        stats[distro] = {
+            'count': len(rs),
+            'errors': sum(1 for r in rs if r['outcome'] == 'error'),
+            'timeouts': sum(1 for r in rs if r['outcome'] == 'timeout'),
+            'failure_rate': sum(1 for r in rs if r['outcome'] != 'ok') / float(len(rs)),
+            'p50': percentile(secs, 50),
+            'p95': percentile(secs, 95),
+            'p99': percentile(secs, 99),
+            'sum': sum(secs),
+            'last_at': max(r.get('at', 0) for r in rs),
+            'mean_connect': statistics.mean(r.get('connect_secs', 0) for r in rs),
+            'mean_first_byte': statistics.mean(r.get('first_byte_secs', 0) for r in rs),
+            'mean_parse': statistics.mean(r.get('parse_secs', 0) for r in rs),
+            'mean_bytes': statistics.mean(r.get('bytes', 0) for r in rs),
+        }
+    return stats
+
+
+def show_stats(args, out):
+    """
+    Print a summary of the recorded metrics.
+    """
+    distros = set()
+    for distro_str in args['--distro']:
+        distros.update({d.split(':')[0].strip() for d in distro_str.split(',')})
+
+    records = get_metrics().load()
+    if len(distros) > 0:
+        records = [r for r in records if r['distro'] in distros]
+    stats = distro_stats(records)
+
+    if args['--prometheus']:
+        out.write(fmt_prometheus(stats))
+        return 0
+
+    if len(stats) == 0:
+        print('error: no lookups have been recorded.', file=out)
+        return 2
+
+    table = [
+        (
+            distro,
+            st['count'],
+            '%.1f%%' % (st['failure_rate'] * 100),
+            '%.3f' % st['p50'],
+            '%.3f' % st['p95'],
+            '%.3f' % st['p99'],
+            '%.3f' % st['mean_connect'],
+            '%.3f' % st['mean_first_byte'],
+            '%.3f' % st['mean_parse'],
+            '%.1f' % (st['mean_bytes'] / 1024.0),
+        )
+        for (distro, st) in sorted(stats.items())
+    ]
+    from tabulate import tabulate
+    print(tabulate(table, headers=[
+        'Distro', 'Lookups', 'Failed', 'p50 (s)', 'p95 (s)', 'p99 (s)',
+        'Connect (s)', 'First byte (s)', 'Parse (s)', 'Size (KB)',
+    ]), file=out)
+    return 0
+
+
+def fmt_prometheus(stats):
+    """
+    Format distro statistics in the Prometheus text exposition format.
+    """
+    lines = [
+        '# HELP decrepit_lookup_seconds Time taken to look up the version for a distro.',
+        '# TYPE decrepit_lookup_seconds summary',
+    ]
+    for (distro, st) in sorted(stats.items()):
+        for (q, key) in (('0.5', 'p50'), ('0.95', 'p95'), ('0.99', 'p99')):
+            lines.append('decrepit_lookup_seconds{distro="%s",quantile="%s"} %r' % (distro, q, st[key]))
+        lines.append('decrepit_lookup_seconds_sum{distro="%s"} %r' % (distro, st['sum']))
+        lines.append('decrepit_lookup_seconds_count{distro="%s"} %d' % (distro, st['count']))
+    lines += [
+        '# HELP decrepit_lookup_failure_ratio Fraction of recent lookups that failed or timed out.',
+        '# TYPE decrepit_lookup_failure_ratio gauge',
+    ]
+    for (distro, st) in sorted(stats.items()):
+        lines.append('decrepit_lookup_failure_ratio{distro="%s"} %r' % (distro, st['failure_rate']))
+    lines += [
+        '# HELP decrepit_lookup_response_bytes Mean bytes downloaded per lookup.',
+        '# TYPE decrepit_lookup_response_bytes gauge',
+    ]
+    for (distro, st) in sorted(stats.items()):
+        lines.append('decrepit_lookup_response_bytes{distro="%s"} %r' % (distro, st['mean_bytes']))
+    return ''.join(l + '\n' for l in lines)
+
+
+def lookup_deadline(distro):
+    """
+    Work out when a lookup for the given distro, starting now, should give up.
+    """
+    timeout = distro_setting(DISTRO_TIMEOUTS, distro, LOOKUP_TIMEOUT)
+    if timeout is None:
+        return None
+    return time.time() + timeout
+
+
+def result_ttl(distro, release):
+    """
+    Work out how long a looked-up version for the given release stays fresh.
+    """
+    default = RESULT_TTL_ROLLING if release == ROLLING else RESULT_TTL
+    return distro_setting(RESULT_TTLS, distro, default)
+
+
+def distro_setting(settings, distro, default):
+    """
+    Look a distro up in a dict of per-distro settings.  Aliases use the
+    setting of the distro they refer to unless they have their own.
+    """
+    name = distro
+    while name is not None:
+        if name in settings:
+            return settings[name]
+        defin = DISTROS.get(name)
+        name = defin if isinstance(defin, str) else None
+    return default
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def time_left():
+    """
+    Returns the number of seconds until the current lookup's deadline, or
+    `None` if it doesn't have one.  Raises `DeadlineExceeded` if it's passed.
+    """
+    deadline = getattr(_LOCAL, 'deadline', None)
+    if deadline is None:
+        return None
+    left = deadline - time.time()
+    if left <= 0:
+        raise DeadlineExceeded('deadline exceeded')
+    return left
+
+
+def single_flight(key, func):
+    """
+    Returns `func()`, unless another lookup in the same `fetch_versions` call
+    has already run, or is running, something with the same `key`; in which
+    case, that result (or exception) is returned instead.
+    """
+    flights = getattr(_LOCAL, 'flights', None)
+    if flights is None:
+        return func()
+    return flights.do(key, func)
+
+
+class SingleFlight:
+    """
+    Makes sure each distinct piece of work is only done once, no matter how
+    many threads want it.  Results are kept for as long as this is.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.futures = {}
+
+    def do(self, key, func):
+        import concurrent.futures
+        with self.lock:
+            future = self.futures.get(key)
+            leader = future is None
+            if leader:
+                future = self.futures[key] = concurrent.futures.Future()
+
+        if leader:
+            try:
+                future.set_result(func())
+            except BaseException as e:
+                future.set_exception(e)
+        else:
+            trace('.. sharing %r' % (key,))
+
+        try:
+            return future.result(timeout=time_left())
+        except concurrent.futures.TimeoutError:
+            raise DeadlineExceeded('deadline exceeded waiting for %r' % (key,))
+
+
+def min_version(vers):
+    """
+    Pick the oldest of some formatted versions, ignoring failed lookups.
+    """
+    vs = sorted(
+        (v for v in vers if v not in ('0.0.0', fmt_ver(TIMED_OUT))),
+        key = lambda v: parse_semver(v),
+    )
+    return (vs + ['unknown'])[0]
+
+
+_WARM = None
+
+def serve(listen, refresh_secs):
+    """
+    Run as a server, answering queries from `query_server`.
+    """
+    global _WARM
+    _WARM = WarmResults()
+
+    # Prime the results with everything in the current profile.
+    profile = find_profile(parse_date(None))
+    if profile is not None:
+        _WARM.get(profile['releases'].items())
+
+    refresher = threading.Thread(
+        target = _WARM.refresh_forever,
+        args = (refresh_secs,),
+        daemon = True,
+    )
+    refresher.start()
+
+    server = make_server(listen)
+    trace('serving on %r' % listen)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if is_unix_addr(listen):
+            try:
+                os.unlink(listen)
+            except OSError:
+                pass
+    return 0
+
+
+class WarmResults:
+    """
+    Versions which have been looked up, kept around so they can be served
+    without looking them up again.  Anything not yet known, known for longer
+    than `ttl` seconds, or whose last lookup failed, is looked up on demand.
+    `refresh_forever` can be used to keep everything up to date in the
+    background instead.
+    """
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.vers = {}
+        self.fetched_at = {}
+
+    def get(self, lookups):
+        lookups = list(dict.fromkeys(lookups))
+        with self.lock:
+            now = time.time()
+            missing = [
+                da for da in lookups
+                if da not in self.vers
+                    or lookup_outcome(self.vers[da]) != 'ok'
+                    or (self.ttl is not None and now - self.fetched_at[da] >= self.ttl)
+            ]
+        if missing:
+            fetched = fetch_versions(missing)
+            with self.lock:
+                self.store(fetched)
+            # Hang on to what was just fetched, in case another thread has
+            # replaced it with something newer in the meantime.
+            vers = dict(fetched)
+        else:
+            vers = {}
+        with self.lock:
+            vers.update({da: self.vers[da] for da in lookups if da not in vers})
+        return vers
+
+    def store(self, vers):
+        now = time.time()
+        self.vers.update(vers)
+        self.fetched_at.update({da: now for da in vers})
+
+    def refresh_forever(self, interval):
+        while True:
+            time.sleep(interval)
+            with self.lock:
+                lookups = list(self.vers.keys())
+            trace('refreshing %d versions' % len(lookups))
+            fetched = fetch_versions(lookups, fresh=True)
+            with self.lock:
+                # Don't throw away a good version because of a failed refresh.
+                self.store({
+                    da: v
+                    for (da, v) in fetched.items()
+                    if v not in (parse_semver('0.0.0'), TIMED_OUT)
+                        or da not in self.vers
+                })
+
+
+def answer_query(argv):
+    """
+    Run a query forwarded by `query_server`, returning its exit status and
+    output.
+    """
+    out = io.StringIO()
+    try:
+        args = docopt.docopt(__doc__, argv=argv, version='decrepit '+__version__)
+        local = local_options(args)
+        if local:
+            raise Exception("the server can't honour %s" % ', '.join(local))
+        status = run_query(args, out)
+    except SystemExit as e:
+        # docopt exits on usage errors.
+        if isinstance(e.code, str):
+            out.write(e.code + '\n')
+            status = 1
+        else:
+            status = e.code
+    except Exception as e:
+        out.write('error: %s\n' % e)
+        status = 1
+    return (status or 0, out.getvalue())
+
+
+# Options that change how versions are looked up.  A server only looks things
+# up the way it was started with, so it can't answer queries that use these.
+LOCAL_OPTIONS = [
+    '--cache-dir', '--cache-size', '--cache-ttl', '--deadline', '--fresh',
+    '--hedge', '--jobs', '--mirror', '--no-cache', '--per-host', '--record',
+    '--replay', '--retries', '--state-dir', '--timeout',
+]
+
+def local_options(args):
+    """
+    Returns which of `LOCAL_OPTIONS` were given, going by whether they differ
+    from their defaults.
+    """
+    defaults = {o.long: o.value for o in docopt.parse_defaults(__doc__)}
+    return [o for o in LOCAL_OPTIONS if args.get(o) != defaults.get(o)]
+
+
+def is_unix_addr(addr):
+    return os.sep in addr or ':' not in addr
+
+
+def make_server(listen):
+    import http.server
+    import socketserver
+
+    class QueryHandler(http.server.BaseHTTPRequestHandler):
+        """
+        Accepts `POST /query` with a JSON body of `{"argv": [...]}`, and
+        responds with `{"status": ..., "output": ...}`.
+        """
+        def do_POST(self):
+            if self.path != '/query':
+                self.send_error(404)
+                return
+            try:
+                length = int(self.headers.get('content-length', 0))
+                argv = json.loads(self.rfile.read(length).decode('utf-8'))['argv']
+            except (ValueError, KeyError) as e:
+                self.send_error(400, str(e))
+                return
+
+            status, output = answer_query(argv)
+            body = json.dumps({'status': status, 'output': output})
+            body = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            trace('serve: ' + fmt % args)
+
+    class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+        def get_request(self):
+            request, _ = super().get_request()
+            # `BaseHTTPRequestHandler` expects a `(host, port)` client address.
+            return (request, ('local', 0))
+
+    if is_unix_addr(listen):
+        if os.path.exists(listen):
+            os.unlink(listen)
+        return UnixHTTPServer(listen, QueryHandler)
+    host, port = listen.rsplit(':', 1)
+    return http.server.ThreadingHTTPServer((host, int(port)), QueryHandler)
+
+
+def query_server(addr, argv):
+    """
+    Forward a query to a running server, printing its answer.  Returns the
+    exit status, or `None` if the server couldn't be reached.
+    """
+    import http.client
+
+    class UnixHTTPConnection(http.client.HTTPConnection):
+        def __init__(self, path, timeout):
+            super().__init__('localhost', timeout=timeout)
+            self.path = path
+
+        def connect(self):
+            import socket
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(self.timeout)
+            self.sock.connect(self.path)
+
+    trace('querying server %r' % addr)
+    try:
+        if is_unix_addr(addr):
+            conn = UnixHTTPConnection(addr, timeout=SERVER_TIMEOUT)
+        else:
+            host, port = addr.rsplit(':', 1)
+            conn = http.client.HTTPConnection(host, int(port), timeout=SERVER_TIMEOUT)
+        body = json.dumps({'argv': argv}).encode('utf-8')
+        conn.request('POST', '/query', body=body,
+            headers={'Content-Type': 'application/json'})
+        resp = conn.getresponse()
+        if resp.status != 200:
+            raise http.client.HTTPException('HTTP %d' % resp.status)
+        result = json.loads(resp.read().decode('utf-8'))
+        conn.close()
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        trace('.. server unavailable (%s); looking up versions directly' % e)
+        return None
+    sys.stdout.write(result['output'])
+    sys.stdout.flush()
+    return result['status']
 
 
 def set_verbose(value):
@@ -390,7 +1965,66 @@ def set_verbose(value):
     VERBOSE = value
 
 
+def set_cache(path=None, ttl=None, max_bytes=None, results=None):
+    global CACHE_DIR, CACHE_TTL, CACHE_MAX_BYTES, USE_RESULTS, _CACHE
+    CACHE_DIR = path
+    if ttl is not None:
+        CACHE_TTL = ttl
+    if max_bytes is not None:
+        CACHE_MAX_BYTES = max_bytes
+    if results is not None:
+        USE_RESULTS = results
+    _CACHE = None
+
+
+def set_network(jobs=None, per_host=None, mirror=None, retries=None, hedge=None):
+    global JOBS, PER_HOST, MIRROR, RETRIES, HEDGE, _POOL
+    if jobs is not None:
+        JOBS = max(1, jobs)
+    if per_host is not None:
+        PER_HOST = max(1, per_host)
+    if retries is not None:
+        RETRIES = max(0, retries)
+    if hedge is not None:
+        HEDGE = hedge
+    MIRROR = mirror
+    if _POOL is not None:
+        _POOL.close()
+    _POOL = None
+
+
+def set_state_dir(path=None):
+    global STATE_DIR
+    STATE_DIR = path
+
+
+def set_archive(record=None, replay=None):
+    global RECORD_DIR, REPLAY_DIR
+    RECORD_DIR = record
+    REPLAY_DIR = replay
+
+
+def set_timeouts(deadline=None, timeouts=None):
+    """
+    Set the overall deadline, and the per-lookup time limits from a string
+    like `30,nixos:120`.
+    """
+    global DEADLINE, LOOKUP_TIMEOUT
+    DEADLINE = deadline
+    for part in (timeouts or '').split(','):
+        part = part.strip()
+        if part == '':
+            continue
+        if ':' in part:
+            distro, secs = part.split(':', 1)
+            DISTRO_TIMEOUTS[distro.strip()] = float(secs)
+        else:
+            LOOKUP_TIMEOUT = float(part)
+
+
 def fmt_ver(ver):
+    if ver == TIMED_OUT:
+        return 'timed out'
     return '%d.%d.%d' % ver
 
 
@@ -407,26 +2041,41 @@ def parse_date(date):
     return '%04d-%02d-%02d' % (date.year, date.month, date.day)
 
 
+def date_range(from_date, to_date, step_days):
+    """
+    Yields normalised dates from `from_date` to `to_date` inclusive.
+    """
+    date = datetime.datetime.strptime(from_date, '%Y-%m-%d').date()
+    end = datetime.datetime.strptime(to_date, '%Y-%m-%d').date()
+    step = datetime.timedelta(days=max(1, step_days))
+    while date <= end:
+        yield parse_date(date.isoformat())
+        date += step
+
+
 def parse_semver(ver):
     m = RE_VER.match(ver)
     return tuple(int(m.group(g)) for g in ('ma', 'mi', 're'))
 
 
-def get_dispatch(distro, arg):
+def get_dispatch(distro, arg, package=DEFAULT_PACKAGE):
     """
     Dispatch to the appropriate scraping function for the given distro.
     """
-    defin = DISTROS[distro]
+    call = 'get_dispatch%r' % ((distro, arg) if package == DEFAULT_PACKAGE else (distro, arg, package),)
+    scraper = SCRAPERS[distro]
     try:
-        if isinstance(defin, type(lambda:None)):
-            return defin(arg)
-        elif isinstance(defin, type("")):
-            return get_dispatch(defin, arg)
-        else:
-            return get_scrape(distro, defin, arg)
+        # Aliases share a scraper, so e.g. `debian` and `debian-testing` asking
+        # for the same release only do it once.  Likewise, packages that a
+        # distro builds from the same source are only looked up once.
+        key = ('fetch', scraper, arg, scraper.package_name(package))
+        return single_flight(key, lambda: scraper.fetch(arg, package))
+    except (DeadlineExceeded, TimeoutError) as e:
+        trace('%s timed out: %s' % (call, e))
+        return TIMED_OUT
     except:
         ex_ty, ex_ob, ex_tb = sys.exc_info()
-        trace('get_dispatch(%r, %r) failed:' % (distro, arg))
+        trace('%s failed:' % call)
         if VERBOSE:
             import traceback
             traceback.print_tb(ex_tb)
@@ -434,16 +2083,19 @@ def get_dispatch(distro, arg):
         return parse_semver('0.0.0')
 
 
-def get_fedora(source):
+def get_fedora(source, package='rust'):
     """
     Get package version by grabbing and parsing package metadata.
     """
-    trace('get_fedora(%r)' % source)
+    trace('get_fedora(%r, %r)' % (source, package))
     URL = ('https://apps.fedoraproject.org/packages/fcomm_connector'
            + '/bodhi/query/query_active_releases/'
-           + '%7B%22filters%22:%7B%22package%22:%22rust%22%7D,'
-           + '%22rows_per_page%22:100%7D')
-    response = json.loads(urlopen(URL).read().decode('utf-8'))
+           + '%7B%22filters%22:%7B%22package%22:%22{package}%22%7D,'
+           + '%22rows_per_page%22:100%7D').format(package=urllib.parse.quote(package))
+    # Every Fedora release comes from the same document, so only fetch and
+    # parse it once.
+    response = single_flight(('json', URL),
+        lambda: json.loads(urlopen(URL).read().decode('utf-8')))
     releases = response.get('rows', [])
     releases = [r for r in releases if source in r.get('release', None)]
     if len(releases) == 0:
@@ -456,143 +2108,1263 @@ def get_fedora(source):
     return parse_semver(ver)
 
 
-def get_freebsd(source):
+FREEBSD_MAKEFILE_REV_XP = "self::tr[td[1]/a/text()='\nMakefile']/td[2]//strong/text()"
+
+def get_freebsd(source, port='lang/rust'):
     """
-    Get package version by scraping a svnweb interface.
+    Get package version from the port's Makefile on svnweb.
     """
-    trace('get_freebsd(%r)' % source)
+    trace('get_freebsd(%r, %r)' % (source, port))
     params = {
         'svnweb': 'https://svnweb.freebsd.org/',
-        'pkg': 'lang/rust',
+        'pkg': port,
     }
     pkg_url = '{svnweb}ports/branches/{rel}/{pkg}'.format(rel=source, **params)
-    makefile_rev_xp = "//tr[td[1]/a/text()='\nMakefile']/td[2]//strong/text()"
-
-    pkg_page = lxml.html.fromstring(urlopen(pkg_url).read())
-    makefile_rev_res = pkg_page.xpath(makefile_rev_xp)[0]
-    rev = ''.join(str(makefile_rev_res))
+    makefile_url = '{svnweb}ports/branches/{rel}/{pkg}/Makefile?view=co'.format(rel=source, **params)
+    rev_url = lambda rev: '{svnweb}ports/branches/{rel}/{pkg}/Makefile?revision={rev}&view=co'.format(rel=source, rev=rev, **params)
+    return get_port_makefile(makefile_url, pkg_url, FREEBSD_MAKEFILE_REV_XP, rev_url,
+        re.compile(r'[$]FreeBSD: \S+ (\d+) '),
+        re.compile(r'(?m)^PORTVERSION[?]?\s*=\s*(\d+[.]\d+[.]\d+)'))
 
-    makefile_url = '{svnweb}ports/branches/{rel}/{pkg}/Makefile?revision={rev}&view=co'.format(rel=source, rev=rev, **params)
-    makefile_page = urlopen(makefile_url).read().decode('utf-8')
-    re_ver = re.compile(r'(?m)^PORTVERSION[?]\s*=\s*(\d+[.]\d+[.]\d+)')
-    ver = re_ver.search(makefile_page).group(1)
-    return parse_semver(ver)
 
+OPENBSD_MAKEFILE_REV_XP = r"self::tr[td[1]/a[3]/text()='Makefile']/td[2]/a/b/text()"
 
-def get_openbsd(source):
+def get_openbsd(source, port='lang/rust'):
     """
-    Get package version by scraping a cvsweb interface.
+    Get package version from the port's Makefile on cvsweb.
     """
-    trace('get_openbsd(%r)' % source)
+    trace('get_openbsd(%r, %r)' % (source, port))
     params = {
         'cvsweb': 'http://cvsweb.openbsd.org/cgi-bin/cvsweb/',
-        'pkg': 'lang/rust',
+        'pkg': port,
         'release_tag': 'OPENBSD_{release_under}',
     }
     tag = params['release_tag'].format(release_under=source.replace('.', '_'))
     pkg_url = '{cvsweb}ports/{pkg}/?only_with_tag={tag}'.format(tag=tag, **params)
-    makefile_rev_xp = r"//tr[td[1]/a[3]/text()='Makefile']/td[2]/a/b/text()"
+    makefile_url = '{cvsweb}~checkout~/ports/{pkg}/Makefile?only_with_tag={tag}'.format(tag=tag, **params)
+    rev_url = lambda rev: '{cvsweb}~checkout~/ports/{pkg}/Makefile?rev={rev}&only_with_tag={tag}'.format(tag=tag, rev=rev, **params)
+    return get_port_makefile(makefile_url, pkg_url, OPENBSD_MAKEFILE_REV_XP, rev_url,
+        re.compile(r'[$]OpenBSD: Makefile,v (\S+) '),
+        re.compile(r'(?m)^V\s*=\s*(\d+[.]\d+[.]\d+)'))
+
+
+def get_port_makefile(makefile_url, pkg_url, rev_xp, rev_url, re_rev, re_ver):
+    """
+    Get a port's version from its Makefile.
+
+    The Makefile at the head of the branch is fetched first, as that's only
+    one request.  If that doesn't work, the revision of the Makefile is
+    scraped from the port's directory listing (`pkg_url`, using `rev_xp`)
+    and that revision (`rev_url(rev)`) is fetched instead.
 
-    pkg_page = lxml.html.fromstring(urlopen(pkg_url).read())
-    makefile_rev_res = pkg_page.xpath(makefile_rev_xp)[0]
+    Versions are remembered by revision (see `MakefileVersions`), so a
+    revision only has to be fetched once.  The revision of the head Makefile
+    comes from its version control keyword, using `re_rev`.
+    """
+    known = get_makefile_versions()
+    try:
+        makefile_page = urlopen(makefile_url).read().decode('utf-8')
+        ver = parse_semver(re_ver.search(makefile_page).group(1))
+    except (DeadlineExceeded, TimeoutError):
+        raise
+    except Exception as e:
+        trace('.. could not use %r, going by revision: %s' % (makefile_url, e))
+    else:
+        m = re_rev.search(makefile_page)
+        if m is not None:
+            known.update(rev_url(m.group(1)), ver)
+        return ver
+
+    with urlopen(pkg_url) as pkg_resp:
+        makefile_rev_res = stream_xpath(pkg_resp, 'tr', rev_xp)[0]
     rev = ''.join(str(makefile_rev_res))
 
-    makefile_url = '{cvsweb}~checkout~/ports/{pkg}/Makefile?rev={rev}&only_with_tag={tag}'.format(tag=tag, rev=rev, **params)
+    makefile_url = rev_url(rev)
+    ver = known.get(makefile_url)
+    if ver is not None:
+        trace('.. already know the version in %r' % makefile_url)
+        return ver
     makefile_page = urlopen(makefile_url).read().decode('utf-8')
-    re_ver = re.compile(r'(?m)^V\s*=\s*(\d+[.]\d+[.]\d+)')
-    ver = re_ver.search(makefile_page).group(1)
-    return parse_semver(ver)
+    ver = parse_semver(re_ver.search(makefile_page).group(1))
+    known.update(makefile_url, ver)
+    return ver
 
 
-def get_nixos(source):
+def get_nixos(source, attr='rustc'):
     """
     Get package version by grabbing and parsing the Nix package metadata.
     """
-    trace('get_nixos(%r)' % source)
+    trace('get_nixos(%r, %r)' % (source, attr))
     assert source == ROLLING, "NixOS is a rolling-only release"
     URL = 'http://nixos.org/nixpkgs/packages.json.gz'
 
-    # We try to cache the metadata because if we *don't*, then successive invocations can take many seconds and that's kinda bluh.
-    trace('.. checking etag')
-    last_etag = None
-    tempdir = tempfile.gettempdir()
-    if tempdir is not None:
-        etag_path = os.path.join(tempdir, 'decrepit-nixos-packages.json.gz.etag')
-        bs_gz_path = os.path.join(tempdir, 'decrepit-nixos-packages.json.gz')
-        try:
-            last_etag = open(etag_path, 'rb').read().decode('utf-8').strip()
-        except:
-            pass
+    want = set(NIXOS_INDEX_PACKAGES) | {attr}
+    index = single_flight(('nixos-index', URL), lambda: load_nixos_index(URL, want))
 
-    trace('.. last_etag: %r' % last_etag)
+    if index.get(attr) is None:
+        raise Exception("could not find %s in NixOS package metadata" % attr)
+    name = index[attr]
 
-    req = urlopen(URL)
-    cur_etag = req.getheader('etag')
-    trace('.. cur_etag:  %r' % cur_etag)
-    json_bs_gz = None
-    if cur_etag == last_etag:
-        trace('.. using cached package data')
-        try:
-            json_bs_gz = open(bs_gz_path, 'rb').read()
-        except:
-            pass
+    re_ver = re.compile(re.escape(attr) + r'-(\d+[.]\d+[.]\d+)')
+    ver = re_ver.search(name).group(1)
+    return parse_semver(ver)
 
-    if json_bs_gz is None:
-        trace('.. redownloading package data')
-        json_bs_gz = req.read()
-        if tempdir is not None:
-            trace('.. caching package data')
-            open(etag_path, 'wb').write(cur_etag.encode('utf-8'))
-            open(bs_gz_path, 'wb').write(json_bs_gz)
 
-    json_bs = gzip.decompress(json_bs_gz)
-    pkgs = json.loads(json_bs.decode('utf-8'))
-    name = pkgs['packages']['rustc']['name']
+def load_nixos_index(url, want):
+    """
+    Returns the names of the `want`ed packages in the NixOS package metadata,
+    or `None` for any that aren't there.
+    """
+    # The metadata is *big*, so rather than inflating and parsing the whole thing, we stream it and stop as soon as we've seen the packages we want.  Those get stashed in a small index next to the cached copy, keyed on the ETag, so that so long as the metadata doesn't change, we never need to look inside it again.
+    cache = get_cache()
+    with urlopen(url) as resp:
+        index_key = resp.getheader('etag') or resp.getheader('last-modified')
+        index = None
+        if cache is not None and index_key is not None:
+            index = cache.load_derived(url, 'index', index_key)
+        if index is None or not want <= set(index):
+            trace('.. building package index')
+            index = {attr: None for attr in want}
+            index.update(
+                (attr, pkg.get('name'))
+                for (attr, pkg)
+                in scan_json_objects(iter_gunzip(resp), want)
+            )
+            if cache is not None and index_key is not None:
+                cache.store_derived(url, 'index', index_key, index)
+        else:
+            trace('.. using cached package index')
+    return index
 
-    re_ver = re.compile(r'rustc-(\d+[.]\d+[.]\d+)')
-    ver = re_ver.search(name).group(1)
-    return parse_semver(ver)
 
+def iter_gunzip(f, chunk_size=64*1024):
+    """
+    Yields the decompressed contents of a gzip stream, a chunk at a time.
+    """
+    z = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        while chunk:
+            data = z.decompress(chunk)
+            if data:
+                yield data
+            # Concatenated gzip members are still one valid gzip file.
+            chunk = z.unused_data if z.eof else b''
+            if z.eof:
+                z = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    data = z.flush()
+    if data:
+        yield data
+
+
+def scan_json_objects(chunks, keys, encoding='utf-8'):
+    """
+    Yields `(key, value)` for object members named in `keys` whose values are
+    themselves objects, reading JSON text incrementally from `chunks` (an
+    iterable of bytes).  Stops reading as soon as every key has been found.
+
+    This doesn't track nesting, so it's only suitable for documents where the
+    keys of interest can't turn up at some other level.  In exchange, memory
+    use is bounded by the size of the matched objects rather than the whole
+    document.
+    """
+    pending = set(keys)
+    if not pending:
+        return
+    pattern = re.compile(
+        r'"(%s)"\s*:\s*[{]' % '|'.join(re.escape(k) for k in sorted(pending)))
+    # Enough to hold a match that straddles two chunks.
+    keep = max(len(k) for k in pending) + 64
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(encoding)()
+    buf = ''
+    for chunk in chunks:
+        buf += text_decoder.decode(chunk)
+        while True:
+            m = pattern.search(buf)
+            if m is None:
+                buf = buf[-keep:]
+                break
+            try:
+                value, end = decoder.raw_decode(buf, m.end() - 1)
+            except ValueError:
+                # The object isn't complete yet; wait for more text.
+                buf = buf[m.start():]
+                break
+            key = m.group(1)
+            buf = buf[end:]
+            if key in pending:
+                pending.remove(key)
+                yield (key, value)
+                if not pending:
+                    return
+
+
+def register_distro(name, defin):
+    """
+    Add (or replace) a distro.  `defin` takes the same forms as the values in
+    `DISTROS`: the name of another distro, a function taking the release, or
+    a dict describing a page to scrape or giving a `func`.
 
-def get_scrape(distro, defin, source):
+    Distros which are aliases of `name` or inherit from it are recompiled too.
     """
-    Get package version by doing generic HTML scraping.
+    DISTROS[name] = defin
+    affected = {n: DISTROS[n] for n in DISTROS if refers_to(n, name)}
+    SCRAPERS.update(compile_distros(affected, DISTROS, SCRAPERS))
 
-    Grabs a URL and evaluates a single XPath expression on it.
+
+def refers_to(name, target):
+    """
+    Whether a distro is `target`, or reaches it through aliases or `inherit`.
     """
-    trace('get_scrape(%r, DISTROS[%r], %r)' % (distro, distro, source))
-    if source is None:
-        source = dict()
-    if isinstance(source, str):
-        source = {'release': source}
+    seen = set()
+    while name is not None and name not in seen:
+        if name == target:
+            return True
+        seen.add(name)
+        defin = DISTROS.get(name)
+        if isinstance(defin, str):
+            name = defin
+        elif isinstance(defin, dict):
+            name = defin.get('inherit')
+        else:
+            name = None
+    return False
+
+
+def compile_distros(defins, all_defins=None, compiled=None):
+    """
+    Turn distro definitions into `Scraper`s, resolving aliases and
+    inheritance up front.  `all_defins` and `compiled` supply definitions and
+    scrapers that aliases and `inherit` may refer to.
+    """
+    all_defins = all_defins if all_defins is not None else defins
+    scrapers = dict(compiled or {})
+    resolving = set()
+    done = set()
+
+    def resolve(name):
+        if name in done or (name in scrapers and name not in defins):
+            return scrapers[name]
+        if name in resolving:
+            raise Exception("distro definition %r refers to itself" % name)
+        resolving.add(name)
+        defin = all_defins[name]
+        if isinstance(defin, str):
+            scraper = resolve(defin)
+        elif callable(defin):
+            scraper = FunctionScraper(name, defin)
+        elif 'func' in defin:
+            scraper = FunctionScraper(name, defin['func'], defin.get('packages'))
+        else:
+            scraper = PageScraper(name, resolve_inherit(defin, all_defins))
+        resolving.remove(name)
+        scrapers[name] = scraper
+        done.add(name)
+        return scraper
+
+    for name in defins:
+        resolve(name)
+    return {name: scrapers[name] for name in defins}
 
-    if not isinstance(source, dict):
-        raise Exception("expected source to be dict, got: %r" % source)
 
+def resolve_inherit(defin, all_defins):
     while 'inherit' in defin:
         inherit = defin['inherit']
-        new_defin = DISTROS[inherit].copy()
+        new_defin = all_defins[inherit].copy()
         new_defin.update({k:v for k,v in defin.items() if k != 'inherit'})
         defin = new_defin
+    return defin
 
-    url = defin['url'].format(**source)
-    xpath = defin['xpath'].format(**source)
-    regex = re.compile(defin['re'])
 
-    page = lxml.html.fromstring(urlopen(url).read())
-    res = page.xpath(xpath)[0]
-    text = ''.join(str(res))
-    m = regex.search(text)
-    if m is not None:
-        version = m.group('version') or '0.0.0'
-    else:
-        version = '0.0.0'
-    return parse_semver(version)
+class Scraper:
+    """
+    Looks up the packaged version of Rust for a particular distro.
+    Subclasses provide `fetch(release, package)`, which returns the version
+    of the package for the given release, as a tuple.
+    """
+    def __init__(self, name, packages=None):
+        self.name = name
+        # Maps package names to the distro's names for them.  `None` means
+        # the scraper only knows about `DEFAULT_PACKAGE`, and doesn't need
+        # to be told its name.
+        self.packages = packages if packages is not None else {DEFAULT_PACKAGE: None}
+
+    def definition(self):
+        """
+        Returns something JSON-able describing how this scraper works.
+        """
+        return {'packages': self.packages}
+
+    def definition_hash(self):
+        """
+        Returns a hash which changes whenever the way this scraper finds
+        versions (probably) does.
+        """
+        if getattr(self, '_definition_hash', None) is None:
+            defin = json.dumps([__version__, type(self).__name__, self.definition()],
+                sort_keys=True, default=repr)
+            self._definition_hash = hashlib.sha1(defin.encode('utf-8')).hexdigest()
+        return self._definition_hash
+
+    def package_name(self, package):
+        """
+        Returns the distro's name for a package.
+        """
+        if package not in self.packages:
+            raise Exception("%s doesn't know about the %r package" % (self.name, package))
+        return self.packages[package]
+
+    def __repr__(self):
+        return '<%s %r>' % (type(self).__name__, self.name)
+
+
+class FunctionScraper(Scraper):
+    def __init__(self, name, func, packages=None):
+        super().__init__(name, packages)
+        self.func = func
+
+    def fetch(self, release, package=DEFAULT_PACKAGE):
+        name = self.package_name(package)
+        if name is None:
+            return self.func(release)
+        return self.func(release, name)
+
+    def definition(self):
+        return dict(super().definition(), func=code_hash(self.func))
+
+
+def code_hash(func):
+    """
+    Returns a hash of a function's code, and the code of any functions in the
+    same module it refers to by name, so it changes when any of them do.
+    """
+    h = hashlib.sha1()
+    seen = set()
+
+    def visit(code, globs):
+        h.update(code.co_code)
+        h.update(repr(code.co_names).encode('utf-8'))
+        for const in code.co_consts:
+            if hasattr(const, 'co_code'):
+                visit(const, globs)
+            else:
+                h.update(repr(const).encode('utf-8'))
+        for name in code.co_names:
+            f = globs.get(name)
+            if (
+                hasattr(f, '__code__') and f not in seen
+                    and getattr(f, '__module__', None) == func.__module__
+            ):
+                seen.add(f)
+                visit(f.__code__, f.__globals__)
+
+    if not hasattr(func, '__code__'):
+        return repr(func)
+    seen.add(func)
+    visit(func.__code__, func.__globals__)
+    return h.hexdigest()
+
+
+class PageScraper(Scraper):
+    """
+    Get package version by doing generic HTML scraping.
+
+    Grabs a URL and evaluates a single XPath expression on it, or matches
+    against elements as they're parsed if the definition has a `tag`.
+    """
+    def __init__(self, name, defin):
+        super().__init__(name, defin.get('packages'))
+        self.defin = defin
+        self.url = defin['url']
+        self.tag = defin.get('tag', None)
+        self.xpath = defin.get('xpath', None)
+        self.regex = re.compile(defin['re'])
+        self.xpaths = {}
+        if self.tag is None and self.xpath is None:
+            raise Exception("distro definition %r needs a `tag` or an `xpath`" % name)
+
+    def fetch(self, source, package=DEFAULT_PACKAGE):
+        trace('%r.fetch(%r, %r)' % (self, source, package))
+        if source is None:
+            source = dict()
+        if isinstance(source, str):
+            source = {'release': source}
+
+        if not isinstance(source, dict):
+            raise Exception("expected source to be dict, got: %r" % source)
+
+        name = self.package_name(package)
+        if name is not None:
+            source = dict(source, package=name)
+
+        url = self.url.format(**source)
+
+        if self.tag is not None:
+            m = None
+            with urlopen(url) as resp:
+                for el in iter_elements(resp, self.tag):
+                    m = self.regex.search(''.join(el.itertext()))
+                    if m is not None:
+                        break
+        else:
+            import lxml.html
+            xpath = self.compiled_xpath(self.xpath.format(**source))
+            page = lxml.html.fromstring(urlopen(url).read())
+            res = xpath(page)[0]
+            text = ''.join(str(res))
+            m = self.regex.search(text)
+
+        if m is not None:
+            version = m.group('version') or '0.0.0'
+        else:
+            version = '0.0.0'
+        return parse_semver(version)
+
+    def definition(self):
+        return dict(super().definition(), **self.defin)
+
+    def compiled_xpath(self, xpath):
+        import lxml.etree
+        if xpath not in self.xpaths:
+            self.xpaths[xpath] = lxml.etree.XPath(xpath)
+        return self.xpaths[xpath]
+
+
+def iter_elements(resp, tag, chunk_size=16*1024):
+    """
+    Yields each element of an HTML response with the given tag as soon as it
+    has been completely parsed.  Stops reading the response as soon as the
+    caller stops asking for elements.
+    """
+    import lxml.etree
+    parser = lxml.etree.HTMLPullParser(events=('end',), tag=tag)
+    while True:
+        chunk = resp.read(chunk_size)
+        if chunk:
+            parser.feed(chunk)
+        else:
+            parser.close()
+        for (_, el) in parser.read_events():
+            yield el
+            # Nothing will look at this again, so don't hang on to it.
+            el.clear()
+        if not chunk:
+            break
+
+
+def stream_xpath(resp, tag, xpath):
+    """
+    Evaluates `xpath` (a string or `lxml.etree.XPath`) relative to each `tag`
+    element of an HTML response as it's parsed, returning the first non-empty
+    result.
+    """
+    import lxml.etree
+    if isinstance(xpath, str):
+        xpath = lxml.etree.XPath(xpath)
+    for el in iter_elements(resp, tag):
+        res = xpath(el)
+        if len(res) > 0:
+            return res
+    return []
 
 
 def urlopen(url):
+    """
+    Open a URL.  If `REPLAY_DIR` is set, the response comes from there;
+    otherwise, it's fetched (see `urlopen_cached`) and, if `RECORD_DIR` is
+    set, saved.
+    """
     trace('urlopen(%r)' % url)
-    return urllib.request.urlopen(url)
+    if REPLAY_DIR is not None:
+        return Archive(REPLAY_DIR).open(url)
+    resp = urlopen_cached(url)
+    if RECORD_DIR is not None:
+        resp = Archive(RECORD_DIR).record(url, resp)
+    return resp
+
+
+def urlopen_cached(url):
+    """
+    Open a URL, going through the page cache if it's enabled.
+
+    Cached pages younger than `CACHE_TTL` are returned as-is; older ones are
+    revalidated with the server using their `ETag` / `Last-Modified` headers.
+    """
+    import urllib.error
+    cache = get_cache()
+    if cache is None:
+        return get_pool().get(url)
+
+    entry = cache.lookup(url)
+    headers = {}
+    if entry is not None:
+        if entry.age() < CACHE_TTL:
+            trace('.. cache hit: %r' % url)
+            return entry.open()
+        etag = entry.getheader('etag')
+        last_modified = entry.getheader('last-modified')
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
+
+    try:
+        resp = get_pool().get(url, headers)
+    except urllib.error.HTTPError as e:
+        if e.code != 304 or entry is None:
+            raise
+        trace('.. cache revalidated: %r' % url)
+        cache.revalidate(entry)
+        return entry.open()
+
+    return cache.store(url, resp)
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+def get_pool():
+    """
+    Returns the process-wide `ConnectionPool`.
+    """
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ConnectionPool(PER_HOST)
+        return _POOL
+
+
+class ConnectionPool:
+    """
+    Keeps idle keep-alive connections around so that successive requests to
+    the same host don't each pay for a new TCP (and TLS) handshake.
+
+    At most `per_host` connections to a given host are in use at once; other
+    requests for that host wait their turn.  A connection is handed back to
+    the pool once its response has been read to the end, and is thrown away
+    if the response is closed early.
+    """
+
+    MAX_REDIRECTS = 5
+    USER_AGENT = 'decrepit/' + __version__
+
+    def __init__(self, per_host):
+        import urllib.request
+        self.per_host = per_host
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.slots = {}
+        self.breakers = {}
+        self.proxies = urllib.request.getproxies()
+
+    def get(self, url, headers=None):
+        """
+        Issue a GET request, following redirects.
+
+        Raises `urllib.error.HTTPError` for any final status other than 200,
+        just like `urllib.request.urlopen`.
+        """
+        import urllib.error
+        url = mirror_url(url)
+        for _ in range(self.MAX_REDIRECTS + 1):
+            resp = self.retrying_request(url, headers or {})
+            if resp.status in (301, 302, 303, 307, 308):
+                location = resp.getheader('location')
+                resp.read()
+                url = urllib.parse.urljoin(url, location)
+                trace('.. redirected to %r' % url)
+                continue
+            if resp.status != 200:
+                body = resp.read()
+                raise urllib.error.HTTPError(url, resp.status, resp.reason,
+                    resp.msg, io.BytesIO(body))
+            return resp
+        raise urllib.error.URLError('too many redirects: %r' % url)
+
+    def retrying_request(self, url, headers):
+        """
+        Issue a request, retrying with jittered exponential backoff if it
+        fails with a connection error or one of `RETRY_STATUSES`, for as long
+        as `RETRIES` and the deadline allow.  Requests to a host that keeps
+        failing are refused by its `CircuitBreaker`.
+        """
+        import http.client
+        import random
+        import urllib.error
+        breaker = self.breaker(urllib.parse.urlsplit(url).netloc)
+        attempt = 0
+        while True:
+            breaker.check()
+            try:
+                resp = self.hedged_request(url, headers)
+            except (DeadlineExceeded, urllib.error.URLError):
+                # These say nothing about the host, but if this request was
+                # the breaker's probe, it mustn't stay in flight forever.
+                breaker.release()
+                raise
+            except (OSError, http.client.HTTPException) as e:
+                breaker.failure()
+                resp, error = None, e
+            except BaseException:
+                breaker.release()
+                raise
+            else:
+                if resp.status not in RETRY_STATUSES:
+                    breaker.success()
+                    return resp
+                breaker.failure()
+                error = 'HTTP %d' % resp.status
+
+            delay = random.uniform(0.5, 1.0) * RETRY_BACKOFF * 2**attempt
+            left = time_left()
+            if attempt >= RETRIES or (left is not None and delay >= left):
+                if resp is not None:
+                    return resp
+                raise error
+            if resp is not None:
+                resp.close()
+            attempt += 1
+            add_metric('retries', 1)
+            trace('.. %s from %r; retrying in %.2fs' % (error, url, delay))
+            time.sleep(delay)
+
+    def hedged_request(self, url, headers):
+        """
+        Issue a request.  If the current lookup has a `hedge_after` delay and
+        there's no response that long after the request was sent, send it
+        again, and use whichever response arrives first.
+        """
+        hedge_after = getattr(_LOCAL, 'hedge_after', None)
+        if hedge_after is None:
+            return self.request(url, headers)
+
+        import queue
+        results = queue.Queue()
+        lock = threading.Lock()
+        state = {'taken': False}
+        sent = threading.Event()
+        deadline = getattr(_LOCAL, 'deadline', None)
+        metrics = getattr(_LOCAL, 'metrics', None)
+
+        def attempt():
+            _LOCAL.deadline = deadline
+            _LOCAL.metrics = metrics
+            try:
+                result = (self.request(url, headers, on_send=sent.set), None)
+            except BaseException as e:
+                result = (None, e)
+            sent.set()
+            with lock:
+                if not state['taken']:
+                    results.put(result)
+                    return
+            # Someone else already answered.
+            if result[0] is not None:
+                result[0].close()
+
+        def wait(timeout):
+            try:
+                return results.get(timeout=timeout)
+            except queue.Empty:
+                return None
+
+        threading.Thread(target=attempt, daemon=True).start()
+        pending = 1
+        try:
+            # Don't count time spent waiting for a connection to the host;
+            # a second request would have to wait too.
+            sent.wait(time_left())
+            result = wait(hedge_after)
+            if result is None:
+                trace('.. no response from %r after %.2fs; hedging' % (url, hedge_after))
+                add_metric('hedges', 1)
+                threading.Thread(target=attempt, daemon=True).start()
+                pending = 2
+            while True:
+                if result is None:
+                    result = wait(time_left())
+                    if result is None:
+                        raise DeadlineExceeded('deadline exceeded waiting for %r' % url)
+                pending -= 1
+                (resp, error) = result
+                if resp is not None or pending == 0:
+                    break
+                # The first attempt failed, but the other might not.
+                result = None
+        finally:
+            with lock:
+                state['taken'] = True
+                leftovers = []
+                while not results.empty():
+                    leftovers.append(results.get())
+            for (other, _) in leftovers:
+                if other is not None:
+                    other.close()
+
+        if error is not None:
+            raise error
+        return resp
+
+    def request(self, url, headers, on_send=None):
+        import http.client
+        import urllib.request
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        proxy = self.proxies.get(parts.scheme)
+        if proxy is not None and urllib.request.proxy_bypass(parts.hostname):
+            proxy = None
+        if proxy is not None and parts.scheme == 'http':
+            path = url
+
+        req_headers = {
+            'User-Agent': self.USER_AGENT,
+            'Accept-Encoding': 'identity',
+        }
+        req_headers.update(headers)
+
+        slot = self.slot(key)
+        timeout = time_left()
+        if not slot.acquire(timeout=-1 if timeout is None else timeout):
+            raise DeadlineExceeded('deadline exceeded waiting for %s' % parts.netloc)
+        if on_send is not None:
+            on_send()
+        try:
+            # A pooled connection may have been closed by the server since we
+            # last used it, so give a reused connection one retry on a fresh one.
+            conn, reused = self.checkout(key, parts, proxy)
+            try:
+                resp = self.send(conn, reused, path, req_headers)
+            except (http.client.HTTPException, ConnectionError):
+                conn.close()
+                if not reused:
+                    raise
+                conn = self.connect(parts, proxy)
+                resp = self.send(conn, False, path, req_headers)
+        except:
+            slot.release()
+            raise
+        return PooledResponse(self, key, conn, resp, slot)
+
+    def send(self, conn, reused, path, headers):
+        add_metric('requests', 1)
+        set_conn_timeout(conn, time_left())
+        if not reused:
+            start = time.perf_counter()
+            conn.connect()
+            add_metric('connect', time.perf_counter() - start)
+        start = time.perf_counter()
+        conn.request('GET', path, headers=headers)
+        resp = conn.getresponse()
+        add_metric('first_byte', time.perf_counter() - start)
+        return resp
+
+    def breaker(self, host):
+        with self.lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker(host)
+            return self.breakers[host]
+
+    def slot(self, key):
+        with self.lock:
+            if key not in self.slots:
+                self.slots[key] = threading.BoundedSemaphore(self.per_host)
+            return self.slots[key]
+
+    def checkout(self, key, parts, proxy):
+        with self.lock:
+            idle = self.idle.get(key, [])
+            if idle:
+                return (idle.pop(), True)
+        return (self.connect(parts, proxy), False)
+
+    def checkin(self, key, conn):
+        with self.lock:
+            self.idle.setdefault(key, []).append(conn)
+
+    def connect(self, parts, proxy):
+        import http.client
+        import urllib.error
+        trace('.. connecting to %s' % parts.netloc)
+        if parts.scheme == 'https':
+            conn_ty = http.client.HTTPSConnection
+        elif parts.scheme == 'http':
+            conn_ty = http.client.HTTPConnection
+        else:
+            raise urllib.error.URLError('unsupported scheme: %r' % parts.scheme)
+
+        if proxy is None:
+            return conn_ty(parts.hostname, parts.port)
+
+        proxy_parts = urllib.parse.urlsplit(proxy)
+        conn = conn_ty(proxy_parts.hostname, proxy_parts.port)
+        if parts.scheme == 'https':
+            conn.set_tunnel(parts.hostname, parts.port)
+        return conn
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle.clear()
+
+
+class CircuitBreaker:
+    """
+    Refuses requests to a host for `BREAKER_COOLDOWN` seconds once
+    `BREAKER_THRESHOLD` requests in a row to it have failed, so that a host
+    which is down doesn't use up every lookup's time.  After the cooldown,
+    one request is let through to see whether it's back.
+    """
+    def __init__(self, host):
+        self.host = host
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def check(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if self.probing or time.time() - self.opened_at < BREAKER_COOLDOWN:
+                import urllib.error
+                raise urllib.error.URLError('too many failed requests to %s' % self.host)
+            trace('.. trying %s again' % self.host)
+            self.probing = True
+
+    def release(self):
+        """
+        Give up on a request without it counting either way.  If it was the
+        probe, another can be let through.
+        """
+        with self.lock:
+            self.probing = False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.failures >= BREAKER_THRESHOLD:
+                if self.opened_at is None:
+                    trace('.. giving up on %s for %ds' % (self.host, BREAKER_COOLDOWN))
+                self.opened_at = time.time()
+
+
+def mirror_url(url):
+    """
+    Rewrite a URL to go through `MIRROR`, if it's set.
+    """
+    if MIRROR is None:
+        return url
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path
+    if parts.query:
+        path += '?' + parts.query
+    return '%s/%s%s' % (MIRROR.rstrip('/'), parts.netloc, path)
+
+
+def set_conn_timeout(conn, timeout):
+    """
+    Set the socket timeout on a (possibly already open) connection.
+    """
+    import socket
+    conn.timeout = socket.getdefaulttimeout() if timeout is None else timeout
+    if conn.sock is not None:
+        conn.sock.settimeout(conn.timeout)
+
+
+class PooledResponse:
+    """
+    Wraps an `http.client.HTTPResponse`, returning its connection to the pool
+    once the body has been fully read.
+    """
+    def __init__(self, pool, key, conn, resp, slot):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.resp = resp
+        self.slot = slot
+        self.status = resp.status
+        self.reason = resp.reason
+        self.msg = resp.msg
+
+    def read(self, amt=None):
+        if self.conn is None:
+            return b''
+        try:
+            set_conn_timeout(self.conn, time_left())
+            start = time.perf_counter()
+            data = self.resp.read(amt)
+            add_metric('download', time.perf_counter() - start)
+            add_metric('bytes', len(data))
+        except:
+            self.release(reuse=False)
+            raise
+        if self.resp.isclosed() or not data:
+            self.release(reuse=not self.resp.will_close)
+        return data
+
+    def getheader(self, name, default=None):
+        return self.resp.getheader(name, default)
+
+    def getheaders(self):
+        return self.resp.getheaders()
+
+    def release(self, reuse):
+        conn, self.conn = self.conn, None
+        if conn is None:
+            return
+        if reuse:
+            self.pool.checkin(self.key, conn)
+        else:
+            conn.close()
+        self.slot.release()
+
+    def close(self):
+        # Anything left unread means the connection is mid-response and can't
+        # be reused.
+        self.release(reuse=False)
+        self.resp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_CACHE = None
+
+def get_cache():
+    """
+    Returns the process-wide `PageCache`, or `None` if caching is disabled.
+    """
+    import tempfile
+    global _CACHE
+    if CACHE_DIR is False:
+        return None
+    if _CACHE is None:
+        path = CACHE_DIR
+        if path is None:
+            path = os.path.join(tempfile.gettempdir(), 'decrepit-cache')
+        _CACHE = PageCache(path, CACHE_MAX_BYTES)
+    return _CACHE
+
+
+class PageCache:
+    """
+    An on-disk cache of HTTP responses which can be shared between processes.
+
+    Each URL gets a single file named after the hash of the URL.  The first
+    line is a JSON object holding the URL, validators and fetch time; the rest
+    is the response body.  Entries are written to a temporary file and renamed
+    into place, so readers never see a partial entry.  The file's modification
+    time is used as the "last used" time for LRU eviction.
+    """
+
+    SUFFIX = '.page'
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def entry_path(self, url, suffix=SUFFIX):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, key + suffix)
+
+    def lookup(self, url):
+        path = self.entry_path(url)
+        try:
+            with open(path, 'rb') as f:
+                meta = json.loads(f.readline().decode('utf-8'))
+        except (OSError, ValueError):
+            return None
+        if meta.get('url') != url:
+            return None
+        return CacheEntry(path, meta)
+
+    def revalidate(self, entry):
+        """
+        Mark an entry as freshly fetched after the server said it's unchanged.
+        """
+        entry.meta['fetched'] = time.time()
+        try:
+            with open(entry.path, 'rb') as f:
+                f.readline()
+                self.write(entry.path, entry.meta, f)
+        except OSError as e:
+            trace('.. could not revalidate cache entry: %s' % e)
+
+    def store(self, url, resp):
+        """
+        Store a response in the cache, returning a response for the cached copy.
+        """
+        meta = {
+            'url': url,
+            'fetched': time.time(),
+            'headers': dict((k.lower(), v) for (k, v) in resp.getheaders()),
+        }
+        return CachingResponse(self, self.entry_path(url), meta, resp)
+
+    def load_derived(self, url, name, key):
+        """
+        Load data derived from a cached page, so long as it was derived from
+        the version identified by `key` (*e.g.* the page's ETag).
+        """
+        try:
+            with open(self.entry_path(url, '.%s.json' % name), 'rb') as f:
+                derived = json.loads(f.read().decode('utf-8'))
+        except (OSError, ValueError):
+            return None
+        if derived.get('key') != key:
+            return None
+        return derived.get('value')
+
+    def store_derived(self, url, name, key, value):
+        """
+        Store data derived from a page.  It's evicted along with the page.
+        """
+        derived = {'url': url, 'key': key, 'value': value}
+        try:
+            self.write(self.entry_path(url, '.%s.json' % name), derived, io.BytesIO())
+        except OSError as e:
+            trace('.. could not store derived data: %s' % e)
+
+    def write(self, path, meta, body):
+        write_atomic(path, chain(
+            [json.dumps(meta).encode('utf-8') + b'\n'],
+            iter(lambda: body.read(64*1024), b''),
+        ))
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in `max_bytes`.
+        """
+        entries = []
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+                # Clean up after processes that died mid-write.
+                if name.endswith('.tmp') and time.time() - st.st_mtime > 3600:
+                    os.unlink(path)
+            except OSError:
+                continue
+            if name.endswith(self.SUFFIX):
+                entries.append((st.st_mtime, st.st_size, path))
+
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, path) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            trace('.. evicting %r' % path)
+            base = path[:-len(self.SUFFIX)]
+            for derived in glob.glob(glob.escape(base) + '.*.json'):
+                try:
+                    os.unlink(derived)
+                except OSError:
+                    pass
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+
+class CachingResponse:
+    """
+    Passes a response through to the caller, writing it to the cache as it's
+    read.  The entry is only added to the cache once the whole body has been
+    seen; if the caller stops reading early, the rest of the body is drained
+    into the cache when the response is closed.
+    """
+    def __init__(self, cache, path, meta, resp):
+        import tempfile
+        self.cache = cache
+        self.path = path
+        self.meta = meta
+        self.resp = resp
+        fd, self.tmp_path = tempfile.mkstemp(dir=cache.path, suffix='.tmp')
+        self.f = os.fdopen(fd, 'wb')
+        self.f.write(json.dumps(meta).encode('utf-8') + b'\n')
+
+    def read(self, amt=None):
+        try:
+            data = self.resp.read(amt)
+            if self.f is not None:
+                self.f.write(data)
+                if amt is None or not data:
+                    self.commit()
+        except:
+            self.abort()
+            raise
+        return data
+
+    def getheader(self, name, default=None):
+        return self.resp.getheader(name, default)
+
+    def getheaders(self):
+        return self.resp.getheaders()
+
+    def commit(self):
+        f, self.f = self.f, None
+        f.close()
+        os.replace(self.tmp_path, self.path)
+        self.cache.evict()
+
+    def abort(self):
+        f, self.f = self.f, None
+        if f is None:
+            return
+        f.close()
+        try:
+            os.unlink(self.tmp_path)
+        except OSError:
+            pass
+
+    def close(self):
+        try:
+            while self.f is not None and self.read(64*1024):
+                pass
+        finally:
+            self.abort()
+            self.resp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CacheEntry:
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+
+    def age(self):
+        return time.time() - self.meta.get('fetched', 0)
+
+    def getheader(self, name, default=None):
+        return self.meta.get('headers', {}).get(name.lower(), default)
+
+    def open(self):
+        f = open(self.path, 'rb')
+        f.readline()
+        try:
+            os.utime(self.path)
+        except OSError:
+            pass
+        return CachedResponse(f, self.meta)
+
+
+class CachedResponse:
+    """
+    Stands in for an `http.client.HTTPResponse` when serving from the cache
+    or an archive.
+    """
+    def __init__(self, f, meta):
+        self.f = f
+        self.meta = meta
+
+    def read(self, amt=None):
+        return self.f.read(-1 if amt is None else amt)
+
+    def getheader(self, name, default=None):
+        return self.meta.get('headers', {}).get(name.lower(), default)
+
+    def getheaders(self):
+        return list(self.meta.get('headers', {}).items())
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Archive:
+    """
+    A directory of recorded responses.
+
+    Each response is stored in its own gzipped file, named after the hash of
+    the URL, holding a line of JSON with the URL and headers followed by the
+    body.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def entry_path(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, key + '.gz')
+
+    def open(self, url):
+        import gzip
+        import urllib.error
+        path = self.entry_path(url)
+        try:
+            f = gzip.open(path, 'rb')
+            meta = json.loads(f.readline().decode('utf-8'))
+        except (OSError, ValueError) as e:
+            raise urllib.error.URLError('no recorded response for %r in %r (%s)'
+                % (url, self.path, e))
+        if meta.get('url') != url:
+            f.close()
+            raise urllib.error.URLError('no recorded response for %r in %r'
+                % (url, self.path))
+        trace('.. replaying %r' % url)
+        return CachedResponse(f, meta)
+
+    def record(self, url, resp):
+        """
+        Save a response, returning a response that replays it.
+        """
+        import gzip
+        import tempfile
+        meta = {
+            'url': url,
+            'recorded': time.time(),
+            'headers': dict((k.lower(), v) for (k, v) in resp.getheaders()),
+        }
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                with gzip.GzipFile(fileobj=f, mode='wb', mtime=0) as gz:
+                    gz.write(json.dumps(meta).encode('utf-8') + b'\n')
+                    with resp:
+                        while True:
+                            chunk = resp.read(64*1024)
+                            if not chunk:
+                                break
+                            gz.write(chunk)
+            os.replace(tmp_path, self.entry_path(url))
+        except:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        trace('.. recorded %r' % url)
+        return self.open(url)
 
 
 def trace(s, newline=True):
@@ -601,8 +3373,11 @@ def trace(s, newline=True):
         sys.stderr.flush()
 
 
+# Distro definitions, compiled once so lookups don't have to.
+SCRAPERS = compile_distros(DISTROS)
+
+
 if __name__ == '__main__':
-    import sys
     if 'idlelib' not in sys.modules:
         r = main(sys.argv)
         if r is not None and r != 0:
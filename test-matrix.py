@@ -9,9 +9,19 @@
 # files in the project carrying such notice may not be copied, modified,
 # or distributed except according to those terms.
 
+import glob
+import hashlib
+import json
+import os
 import os.path
 import re
+import shutil
+import signal
+import subprocess
 import sys
+import threading
+import time
+import toml
 import yaml
 
 from common import *
@@ -19,12 +29,40 @@ from itertools import chain
 
 LOG_DIR = os.path.join('local', 'tests')
 
+# Where dependency artifacts shared between cells are kept.  See
+# `ArtifactStore`.
+ARTIFACT_DIR = os.path.join('local', 'artifacts')
+
+# Artifacts for toolchains and environments that haven't been used for this
+# many days are dropped from the store.
+ARTIFACT_MAX_AGE_DAYS = 14
+
+# How big the store may get, in bytes, before the least recently used
+# artifacts are dropped.  Whatever the last run used is always kept.
+ARTIFACT_MAX_BYTES = 10 * 1024 * 1024 * 1024
+
+# How many cells to run at once.  Overridden by `-j N`.
+JOBS = 1
+
+# How much memory to assume a cell needs before it has been run once.
+CELL_RSS_GUESS = 1024 * 1024 * 1024
+
+# How many past results of each cell to keep for deciding which cells to run
+# first.
+OUTCOME_HISTORY = 20
+
 set_toolbox_trace(env_var='TRACE_TEST_MATRIX')
 
 def main():
     load_globals_from_metadata('test-matrix', globals(),
         {
+            'ARTIFACT_DIR',
+            'ARTIFACT_MAX_AGE_DAYS',
+            'ARTIFACT_MAX_BYTES',
+            'CELL_RSS_GUESS',
+            'JOBS',
             'LOG_DIR',
+            'OUTCOME_HISTORY',
         })
 
     travis = yaml.load(open('.travis.yml'))
@@ -36,12 +74,30 @@ def main():
     vers = set(default_rust_vers)
     include_vers = []
     exclude_vers = set()
+    jobs = JOBS
+    share = True
+    force = False
+    fail_fast = False
 
     if not os.path.exists(LOG_DIR):
         os.makedirs(LOG_DIR)
 
-    for arg in sys.argv[1:]:
-        if arg in vers and arg not in include_vers:
+    args = sys.argv[1:]
+    while args:
+        arg = args.pop(0)
+        if arg.startswith('-j') and arg[1:] not in vers:
+            n = arg[2:] or (args.pop(0) if args else '')
+            if not n.isdigit() or int(n) < 1:
+                msg("`-j` needs a number of jobs, not `%s`." % n)
+                sys.exit(1)
+            jobs = int(n)
+        elif arg == '--no-share':
+            share = False
+        elif arg == '--force':
+            force = True
+        elif arg == '--fail-fast':
+            fail_fast = True
+        elif arg in vers and arg not in include_vers:
             include_vers.append(arg)
         elif arg.startswith('-') and arg[1:] in vers:
             exclude_vers.add(arg[1:])
@@ -55,7 +111,7 @@ def main():
     rust_vers = [v for v in include_vers if v not in exclude_vers]
     msg('Tests will be run for: %s' % ', '.join(rust_vers))
 
-    results = []
+    cells = []
     for rust_ver in rust_vers:
         seq_id = 0
         for env_var_str in travis.get('env', [""]):
@@ -70,15 +126,36 @@ def main():
                 cmd_env.update(env_vars)
                 cmd_env.update(row_env_vars)
 
-                success = run_script(script, rust_ver, seq_id, cmd_env)
-                results.append((rust_ver, seq_id, success))
+                cells.append((rust_ver, seq_id, cmd_env))
                 seq_id += 1
 
+    store = None
+    if share and ARTIFACT_DIR:
+        store = ArtifactStore(ARTIFACT_DIR, local_package_names())
+
+    results = run_cells(script, cells, jobs, store, force, fail_fast)
+
     print("")
 
     msg('Results:')
-    for rust_ver, seq_id, success in results:
-        msg('%s #%d: %s' % (rust_ver, seq_id, 'OK' if success else 'Failed!'))
+    for rust_ver, seq_id, success, unchanged in results:
+        msg('%s #%d: %s%s' % (rust_ver, seq_id, describe_result(success),
+            ' (unchanged)' if unchanged else ''))
+
+    if store is not None:
+        msg('Artifact store: %d reused, %d built (%d%% hit rate), %.1f MB shared' % (
+            store.hits, store.misses,
+            100 * store.hits // max(1, store.hits + store.misses),
+            store.shared_bytes / (1024.0 * 1024.0)))
+        try:
+            keys, objects, freed = store.prune(ARTIFACT_MAX_AGE_DAYS * 24 * 3600, ARTIFACT_MAX_BYTES)
+        except (IOError, OSError) as e:
+            msg_trace('ArtifactStore.prune failed: %s' % e)
+        else:
+            if objects:
+                msg('Artifact store: dropped %d key%s and %d file%s, %.1f MB freed' % (
+                    keys, '' if keys == 1 else 's', objects, '' if objects == 1 else 's',
+                    freed / (1024.0 * 1024.0)))
 
 def parse_env_vars(s):
     env_vars = {}
@@ -88,12 +165,323 @@ def parse_env_vars(s):
         env_vars[k] = v
     return env_vars
 
-def run_script(script, rust_ver, seq_id, env):
+def run_cells(script, cells, jobs, store=None, force=False, fail_fast=False):
+    """
+    Runs the matrix cells, up to `jobs` at a time.  Returns a list of
+    `(rust_ver, seq_id, success, unchanged)` in the same order as `cells`;
+    `success` is `None` for cells that were cancelled.
+
+    Cells whose inputs are the same as when they last ran (see
+    `cell_fingerprint`) aren't run again, and keep their last result, unless
+    `force` is set.
+
+    The rest are run in order of how likely they are to fail, then how
+    quickly they ran last time (see `schedule_key`).  With `fail_fast`, the
+    first failure cancels every cell that hasn't finished.
+
+    A cell is only started if there's a core and enough memory free for it,
+    going by the peak RSS it had the last time it ran (see `load_history`).
+    At least one cell is always running, however big it is.
+    """
+    history = load_history()
+    tree_hash = source_tree_hash()
+    fingerprints = {}
+    results = {}
+    pending = []
+    progress = Progress(len(cells))
+    for (i, cell) in enumerate(cells):
+        rust_ver, seq_id, env = cell
+        fingerprints[i] = cell_fingerprint(tree_hash, script, rust_ver, env)
+        last = history.get(cell_key(rust_ver, seq_id), {})
+        if (not force and fingerprints[i] is not None
+                and last.get('fingerprint') == fingerprints[i]):
+            results[i] = (rust_ver, seq_id, last['success'], True)
+            progress.finished(rust_ver, seq_id, last['success'], unchanged=True)
+        else:
+            pending.append((i, cell))
+    pending.sort(key=lambda ic: schedule_key(history.get(cell_key(ic[1][0], ic[1][1]), {})))
+
+    cores = os.cpu_count() or 1
+    jobs = min(jobs, cores, len(pending)) or 1
+    mem_budget = available_memory()
+    msg_trace('run_cells: jobs=%d, cores=%d, mem_budget=%r' % (jobs, cores, mem_budget))
+
+    def need_mem(cell):
+        rss = history.get(cell_key(cell[0], cell[1]), {}).get('peak_rss')
+        if rss is None:
+            rss = CELL_RSS_GUESS
+        return rss
+
+    cond = threading.Condition()
+    running = {}
+    canceller = Canceller()
+
+    def cancel_pending():
+        if pending:
+            progress.clear()
+            msg('Cancelling %d cell%s that %s not started.' % (
+                len(pending), '' if len(pending) == 1 else 's',
+                'has' if len(pending) == 1 else 'have'))
+            progress.last_line = None
+        for (i, cell) in pending:
+            results[i] = (cell[0], cell[1], None, False)
+        del pending[:]
+        canceller.cancel()
+
+    if fail_fast and any(r[2] is False for r in results.values()):
+        cancel_pending()
+
+    def run(i, cell):
+        rust_ver, seq_id, env = cell
+        env = dict(env)
+        if jobs > 1 and 'CARGO_BUILD_JOBS' not in env:
+            # Share the cores out rather than have every cargo use them all.
+            env['CARGO_BUILD_JOBS'] = str(max(1, cores // jobs))
+        start = time.time()
+        remember = True
+        try:
+            success, peak_rss = run_script(script, rust_ver, seq_id, env, store, canceller)
+        except Exception as e:
+            msg_trace('run_script(%r, %d) failed: %s' % (rust_ver, seq_id, e))
+            # Don't remember that as the cell's result.
+            success, peak_rss, remember = False, None, False
+        duration = time.time() - start
+        with cond:
+            del running[i]
+            results[i] = (rust_ver, seq_id, success, False)
+            if success is not None and remember:
+                last = history.setdefault(cell_key(rust_ver, seq_id), {})
+                last['fingerprint'] = fingerprints[i]
+                last['success'] = success
+                last['duration'] = duration
+                last['outcomes'] = (last.get('outcomes', []) + [success])[-OUTCOME_HISTORY:]
+                if peak_rss is not None:
+                    last['peak_rss'] = peak_rss
+                try:
+                    save_history(history)
+                except (IOError, OSError) as e:
+                    msg_trace('save_history failed: %s' % e)
+            progress.finished(rust_ver, seq_id, success)
+            if fail_fast and success is False:
+                cancel_pending()
+            cond.notify()
+
+    try:
+        with cond:
+            while pending or running:
+                in_use = sum(running.values())
+                for (i, cell) in list(pending):
+                    if len(running) >= jobs:
+                        break
+                    mem = need_mem(cell)
+                    if running and mem_budget is not None and in_use + mem > mem_budget:
+                        continue
+                    pending.remove((i, cell))
+                    running[i] = mem
+                    in_use += mem
+                    progress.started(cell[0], cell[1])
+                    threading.Thread(target=run, args=(i, cell), daemon=True).start()
+                progress.show(waiting=len(pending) if len(running) < jobs else 0)
+                if pending or running:
+                    cond.wait()
+    except KeyboardInterrupt:
+        # The cells' commands run in their own sessions, so they won't have
+        # seen the ^C.
+        canceller.cancel()
+        progress.done()
+        raise
+
+    progress.done()
+    return [results[i] for i in range(len(cells))]
+
+class Progress(object):
+    """
+    A one-line summary of how the matrix is going, redrawn as cells start and
+    finish.  Without ANSI support, it's printed whenever it changes.
+    """
+    def __init__(self, total):
+        self.total = total
+        self.finished_count = 0
+        self.failed_count = 0
+        self.running = []
+        self.last_line = None
+
+    def started(self, rust_ver, seq_id):
+        self.running.append('%s #%d' % (rust_ver, seq_id))
+
+    def finished(self, rust_ver, seq_id, success, unchanged=False):
+        if not unchanged:
+            self.running.remove('%s #%d' % (rust_ver, seq_id))
+        self.finished_count += 1
+        if success is False:
+            self.failed_count += 1
+        self.clear()
+        msg('%s #%d: %s%s' % (rust_ver, seq_id, describe_result(success),
+            ' (unchanged)' if unchanged else ''))
+        self.last_line = None
+
+    def show(self, waiting=0):
+        line = '[%d/%d done, %d failed] running %s' % (
+            self.finished_count, self.total, self.failed_count,
+            ', '.join(self.running) or 'nothing')
+        if waiting:
+            line += '; %d waiting for memory' % waiting
+        if line == self.last_line:
+            return
+        self.last_line = line
+        if USE_ANSI:
+            sys.stdout.write('\r\x1b[K\x1b[1;34m> \x1b[0m' + line)
+            sys.stdout.flush()
+        else:
+            msg(line)
+
+    def clear(self):
+        if USE_ANSI and self.last_line is not None:
+            sys.stdout.write('\r\x1b[K')
+            sys.stdout.flush()
+
+    def done(self):
+        self.clear()
+
+def describe_result(success):
+    return {True: 'OK', False: 'Failed!', None: 'Cancelled'}[success]
+
+def cell_key(rust_ver, seq_id):
+    return '%s-%d' % (rust_ver, seq_id)
+
+def schedule_key(last):
+    """
+    Sort key for running cells, given what happened to them before: cells
+    that failed last time first, then the ones that fail most often, then
+    the quickest.  Cells that have never run come after ones that failed last
+    time, but before the rest.
+    """
+    outcomes = last.get('outcomes', [])
+    if not outcomes:
+        return (1, 0.0, 0.0)
+    group = 0 if outcomes[-1] is False else 2
+    failure_rate = outcomes.count(False) / float(len(outcomes))
+    return (group, -failure_rate, last.get('duration', 0.0))
+
+def cell_fingerprint(tree_hash, script, rust_ver, env):
+    """
+    Returns a hash of everything that goes into a cell's result: the source
+    tree, `Cargo.lock`, the toolchain, the cell's env and the script.  Returns
+    `None` if the toolchain can't be identified.
+    """
+    version = toolchain_version(rust_ver)
+    if version is None:
+        return None
+    inputs = json.dumps([tree_hash, file_hash('Cargo.lock'), version, sorted(env.items()), script])
+    return hashlib.sha256(inputs.encode('utf-8')).hexdigest()
+
+def source_tree_hash():
+    """
+    Returns a hash of the names and contents of the files in the source tree.
+    Under git, that's the files git doesn't ignore; otherwise, it's everything
+    but `.git`.  Either way, build output, logs and artifacts are left out.
+    """
+    try:
+        listing = subprocess.check_output(
+            'git ls-files -z --cached --others --exclude-standard',
+            shell=True, stderr=subprocess.DEVNULL).decode('utf-8')
+        paths = [os.path.normpath(p) for p in listing.split('\0') if p != '']
+    except Exception as e:
+        msg_trace('source_tree_hash: not using git: %s' % e)
+        paths = []
+        for (dirpath, dirnames, filenames) in os.walk('.'):
+            dirnames[:] = [d for d in dirnames if d != '.git']
+            paths.extend(os.path.relpath(os.path.join(dirpath, f)) for f in filenames)
+    skip = tuple(os.path.normpath(d) + os.sep for d in ('target', LOG_DIR, ARTIFACT_DIR) if d)
+    paths = [p for p in paths if not p.startswith(skip)]
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        digest.update(('%s\0%s\0' % (path, file_hash(path))).encode('utf-8'))
+    return digest.hexdigest()
+
+def file_hash(path):
+    """
+    Returns a hash of a file's contents, or `None` if it doesn't exist.
+    """
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+    except (IOError, OSError):
+        return None
+    return digest.hexdigest()
+
+_TOOLCHAINS = {}
+_TOOLCHAINS_LOCK = threading.Lock()
+
+def toolchain_version(rust_ver):
+    """
+    Returns the `rustc -vV` of a toolchain, or `None` if it can't be run.
+    """
+    with _TOOLCHAINS_LOCK:
+        if rust_ver in _TOOLCHAINS:
+            return _TOOLCHAINS[rust_ver]
+    try:
+        version = sh_eval('%s run %s rustc -vV' % (RUSTUP, rust_ver))
+    except Exception as e:
+        msg_trace('toolchain_version(%r): %s' % (rust_ver, e))
+        version = None
+    with _TOOLCHAINS_LOCK:
+        _TOOLCHAINS[rust_ver] = version
+    return version
+
+def history_path():
+    return os.path.join(LOG_DIR, 'history.json')
+
+def load_history():
+    """
+    Loads what was measured about each cell on previous runs, keyed by
+    `cell_key`.
+    """
+    try:
+        with open(history_path(), 'rt') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def save_history(history):
+    tmp_path = history_path() + '.tmp'
+    with open(tmp_path, 'wt') as f:
+        json.dump(history, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, history_path())
+
+def available_memory():
+    """
+    Returns roughly how many bytes of memory are free for running tests, or
+    `None` if that can't be worked out.
+    """
+    try:
+        with open('/proc/meminfo', 'rt') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def run_script(script, rust_ver, seq_id, env, store=None, canceller=None):
+    """
+    Runs the script for one cell, logging to its own file.  Returns whether
+    it succeeded (`None` if it was cancelled) and the peak RSS of its largest
+    command in bytes, or `None` if that couldn't be measured.
+
+    If there's a `store`, the cell's target dir is seeded from it first, and
+    whatever the cell built is added to it afterwards.
+    """
     target_dir = os.path.join('target', '%s-%d' % (rust_ver, seq_id))
     log_path = os.path.join(LOG_DIR, '%s-%d.log' % (rust_ver, seq_id))
     log_file = open(log_path, 'wt')
-    msg('Running tests for %s #%d...' % (rust_ver, seq_id))
     success = True
+    peak_rss = None
 
     def sub_env(m):
         name = m.group(1) or m.group(2)
@@ -107,25 +495,384 @@ def run_script(script, rust_ver, seq_id, env):
     cmd_env['CARGO_TARGET_DIR'] = target_dir
     cmd_env.update(env)
 
+    store_key = None
+    if store is not None:
+        store_key = store.key(rust_ver, cmd_env)
+        seeded = store.seed(store_key, target_dir)
+        before = store.fingerprints(target_dir)
+        log_file.write('# seeded %d files from %s\n' % (len(seeded), store.path))
+
     for cmd in script:
         cmd = re.sub(r"\$(?:([A-Za-z0-9_]+)|{([A-Za-z0-9_]+)})\b", sub_env, cmd)
         cmd_str = '> %s run %s %s' % (RUSTUP, rust_ver, cmd)
         log_file.write(cmd_str)
         log_file.write("\n")
         log_file.flush()
-        success = sh(
+        success, rss = sh_measured(
             '%s run %s %s' % (RUSTUP, rust_ver, cmd),
-            checked=False,
             stdout=log_file, stderr=log_file,
             env=cmd_env,
+            canceller=canceller,
             )
+        if rss is not None:
+            peak_rss = max(peak_rss or 0, rss)
+        if canceller is not None and canceller.cancelled:
+            log_file.write('Cancelled.\n')
+            log_file.flush()
+            success = None
+            break
         if not success:
             log_file.write('Command failed.\n')
             log_file.flush()
             break
-    msg('... ', 'OK' if success else 'Failed!')
+    if store_key is not None:
+        store.ingest(store_key, target_dir, seeded, before)
     log_file.close()
-    return success
+    return success, peak_rss
+
+def local_package_names():
+    """
+    Returns the names of the packages in this workspace, whose artifacts
+    change with every edit and so aren't worth sharing.
+    """
+    names = set()
+    manifests = ['Cargo.toml']
+    i = 0
+    while i < len(manifests):
+        try:
+            with open(manifests[i], 'rt') as manifest_file:
+                manifest = toml.loads(manifest_file.read())
+        except (IOError, ValueError):
+            manifest = {}
+        name = manifest.get('package', {}).get('name')
+        if name is not None:
+            names.add(name)
+        if i == 0:
+            for member in manifest.get('workspace', {}).get('members', []):
+                for path in glob.glob(member):
+                    manifests.append(os.path.join(path, 'Cargo.toml'))
+        i += 1
+    return names
+
+class ArtifactStore(object):
+    """
+    A content-addressed store of dependency artifacts, shared between the
+    target dirs of matrix cells.
+
+    Artifacts are grouped by a key made from the toolchain (`rustc -vV`), the
+    target, and any environment variables that affect how things are built
+    (see `key`).  Cargo already puts a hash of the crate's version, features,
+    profile and flags in each artifact's file name, so artifacts that end up
+    with the same path under the same key are interchangeable.
+
+    Compiler outputs in `deps` are hard-linked into target dirs; rustc and
+    the linkers replace these rather than write into them.  Everything else
+    (fingerprints, build script output, ...) is small and may be rewritten
+    in place, so it's copied.  Artifacts of the workspace's own packages
+    aren't shared.
+
+    Every toolchain update starts a new key, so the store is pruned after
+    each run; see `prune`.
+    """
+    KINDS = ('deps', 'build', '.fingerprint')
+    LINK_EXTS = ('.rlib', '.rmeta', '.so', '.dylib', '.dll', '.a', '.lib')
+    RE_UNIT = re.compile(r'^(?:lib)?(?P<name>.+)-[0-9a-f]{16}(?:[.].*)?$')
+
+    # Environment variables which don't change what gets built.
+    IGNORED_ENV = frozenset([
+        'CARGO_BUILD_JOBS',
+        'CARGO_HOME',
+        'CARGO_TARGET_DIR',
+        'CARGO_TERM_COLOR',
+        'CARGO_TERM_VERBOSE',
+    ])
+
+    def __init__(self, path, local_names):
+        self.path = path
+        self.local_names = set(chain(local_names, (n.replace('-', '_') for n in local_names)))
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.shared_bytes = 0
+        self.used_keys = set()
+
+    def key(self, rust_ver, env):
+        """
+        Returns the key for artifacts built with the given toolchain and
+        environment, or `None` if the toolchain can't be identified.
+        """
+        version = toolchain_version(rust_ver)
+        if version is None:
+            return None
+        host = re.search(r'(?m)^host: (\S+)', version)
+        target = env.get('CARGO_BUILD_TARGET') or (host.group(1) if host else '')
+        build_env = sorted(
+            (k, v) for (k, v) in env.items()
+            if (k.startswith('CARGO_') or k.startswith('RUST'))
+                and k not in self.IGNORED_ENV
+        )
+        key = json.dumps([version, target, build_env])
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+    def manifest_path(self, key):
+        return os.path.join(self.path, 'keys', key + '.json')
+
+    def object_path(self, digest):
+        return os.path.join(self.path, 'objects', digest[:2], digest)
+
+    def load_manifest(self, key):
+        try:
+            with open(self.manifest_path(key), 'rt') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def seed(self, key, target_dir):
+        """
+        Fills in anything the store has for `key` which `target_dir` doesn't
+        already have.  Returns the relpaths of the files added.
+        """
+        if key is None:
+            return set()
+        with self.lock:
+            self.used_keys.add(key)
+        try:
+            # Mark the key as used, for `prune`.
+            os.utime(self.manifest_path(key))
+        except OSError:
+            pass
+        seeded = set()
+        for (rel, entry) in sorted(self.load_manifest(key).items()):
+            dst = os.path.join(target_dir, rel)
+            src = self.object_path(entry['object'])
+            if os.path.lexists(dst) or not os.path.exists(src):
+                continue
+            try:
+                if not os.path.isdir(os.path.dirname(dst)):
+                    os.makedirs(os.path.dirname(dst))
+                if self.is_linked(rel):
+                    os.link(src, dst)
+                    with self.lock:
+                        self.shared_bytes += entry['size']
+                else:
+                    shutil.copy2(src, dst)
+            except (IOError, OSError) as e:
+                msg_trace('ArtifactStore.seed: %s: %s' % (rel, e))
+                continue
+            seeded.add(rel)
+        return seeded
+
+    def fingerprints(self, target_dir):
+        """
+        Returns `{unit: {relpath: mtime_ns}}` for the fingerprint files in a
+        target dir, which cargo rewrites whenever it builds a unit.
+        """
+        units = {}
+        for (rel, path) in self.walk(target_dir):
+            parts = rel.split(os.sep)
+            if '.fingerprint' in parts[:-1]:
+                unit = os.sep.join(parts[:parts.index('.fingerprint') + 2])
+                units.setdefault(unit, {})[rel] = os.stat(path).st_mtime_ns
+        return units
+
+    def ingest(self, key, target_dir, seeded, before):
+        """
+        Adds the dependency artifacts in `target_dir` to the store.  Units
+        built since `before` (see `fingerprints`) count as misses, and units
+        seeded from the store and left alone count as hits.
+        """
+        manifest = self.load_manifest(key)
+        found = {}
+        for (rel, abs_path) in self.walk(target_dir):
+            try:
+                st = os.stat(abs_path)
+                entry = manifest.get(rel)
+                if (entry is None or entry['size'] != st.st_size
+                        or entry['mtime_ns'] != st.st_mtime_ns):
+                    entry = self.add_object(rel, abs_path, st)
+                found[rel] = entry
+            except (IOError, OSError) as e:
+                msg_trace('ArtifactStore.ingest: %s: %s' % (rel, e))
+
+        hits = misses = 0
+        for (unit, files) in self.fingerprints(target_dir).items():
+            if files != before.get(unit):
+                misses += 1
+            elif any(rel in seeded for rel in files):
+                hits += 1
+
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+            # Another cell with the same key may have saved in the meantime.
+            manifest = self.load_manifest(key)
+            manifest.update(found)
+            path = self.manifest_path(key)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path + '.tmp', 'wt') as f:
+                json.dump(manifest, f, sort_keys=True)
+            os.replace(path + '.tmp', path)
+
+    def prune(self, max_age, max_bytes):
+        """
+        Drops the keys which haven't been used for `max_age` seconds, then the
+        least recently used ones until the objects the rest refer to fit in
+        `max_bytes`, then any objects no key refers to.  Keys used by this run
+        are always kept.  Returns how many keys and objects were removed, and
+        how many bytes that freed.
+        """
+        with self.lock:
+            now = time.time()
+            manifests = []
+            for path in glob.glob(os.path.join(self.path, 'keys', '*.json')):
+                key = os.path.splitext(os.path.basename(path))[0]
+                used_at = now if key in self.used_keys else os.stat(path).st_mtime
+                manifests.append((used_at, key, path))
+            manifests.sort(reverse=True)
+
+            sizes = {}
+            for obj in glob.glob(os.path.join(self.path, 'objects', '*', '*')):
+                sizes[os.path.basename(obj)] = os.stat(obj).st_size
+
+            keep = set()
+            kept_bytes = 0
+            dropped_keys = 0
+            for (used_at, key, path) in manifests:
+                objects = set(e['object'] for e in self.load_manifest(key).values())
+                new_bytes = sum(sizes.get(o, 0) for o in objects - keep)
+                if key not in self.used_keys and (now - used_at > max_age
+                        or kept_bytes + new_bytes > max_bytes):
+                    msg_trace('ArtifactStore.prune: dropping key %s' % key)
+                    os.remove(path)
+                    dropped_keys += 1
+                    continue
+                keep |= objects
+                kept_bytes += new_bytes
+
+            dropped_objects = freed = 0
+            for (digest, size) in sizes.items():
+                if digest not in keep:
+                    os.remove(self.object_path(digest))
+                    dropped_objects += 1
+                    freed += size
+            return dropped_keys, dropped_objects, freed
+
+    def add_object(self, rel, abs_path, st):
+        digest = hashlib.sha256()
+        with open(abs_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        digest = digest.hexdigest()
+        obj = self.object_path(digest)
+        if not os.path.exists(obj):
+            if not os.path.isdir(os.path.dirname(obj)):
+                os.makedirs(os.path.dirname(obj))
+            tmp = '%s.%d.tmp' % (obj, threading.get_ident())
+            if self.is_linked(rel):
+                os.link(abs_path, tmp)
+            else:
+                shutil.copy2(abs_path, tmp)
+            os.replace(tmp, obj)
+        return {'object': digest, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+    def walk(self, target_dir):
+        """
+        Yields `(relpath, path)` for each shareable file in a target dir:
+        everything under `[<triple>/]<profile>/{deps,build,.fingerprint}`
+        which doesn't belong to a local package.
+        """
+        for kind in self.KINDS:
+            for pattern in (('*', kind), ('*', '*', kind)):
+                for kind_dir in glob.glob(os.path.join(target_dir, *pattern)):
+                    for name in os.listdir(kind_dir):
+                        m = self.RE_UNIT.match(name)
+                        if m is None or m.group('name') in self.local_names:
+                            continue
+                        top = os.path.join(kind_dir, name)
+                        paths = [top]
+                        if os.path.isdir(top):
+                            paths = (os.path.join(dirpath, f)
+                                for (dirpath, _, files) in os.walk(top)
+                                for f in files)
+                        for path in paths:
+                            if os.path.isfile(path) and not path.endswith('.tmp'):
+                                yield (os.path.relpath(path, target_dir), path)
+
+    def is_linked(self, rel):
+        parts = rel.split(os.sep)
+        return (len(parts) >= 2 and parts[-2] == 'deps'
+            and os.path.splitext(rel)[1] in self.LINK_EXTS)
+
+def sh_measured(cmd, env=None, stdout=None, stderr=None, canceller=None):
+    """
+    Like `sh(cmd, checked=False)`, but also returns the peak RSS in bytes of
+    the biggest process the command ran, where the OS can tell us that.
+
+    With a `canceller`, the command runs in its own session so that it and
+    everything it starts can be killed; see `Canceller`.
+    """
+    msg_trace('sh_measured(%r, env=%r)' % (cmd, env))
+    try:
+        proc = subprocess.Popen(cmd, env=env, stdout=stdout, stderr=stderr, shell=True,
+            start_new_session=canceller is not None and os.name == 'posix')
+    except Exception as e:
+        msg_trace('FAILED: %s' % e)
+        return False, None
+    if canceller is not None:
+        canceller.started(proc)
+    try:
+        if not hasattr(os, 'wait4'):
+            return proc.wait() == 0, None
+        _, status, usage = os.wait4(proc.pid, 0)
+    finally:
+        if canceller is not None:
+            canceller.stopped(proc)
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    if proc.returncode != 0:
+        msg_trace('FAILED: exit status %d' % proc.returncode)
+    # `ru_maxrss` is in kilobytes, except on macOS.
+    rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return proc.returncode == 0, rss
+
+class Canceller(object):
+    """
+    Keeps track of the commands cells are running, so they can all be killed
+    at once, along with anything they started.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.procs = set()
+        self.cancelled = False
+
+    def started(self, proc):
+        with self.lock:
+            self.procs.add(proc)
+            cancelled = self.cancelled
+        if cancelled:
+            self.kill(proc)
+
+    def stopped(self, proc):
+        with self.lock:
+            self.procs.discard(proc)
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            procs = list(self.procs)
+        for proc in procs:
+            self.kill(proc)
+
+    def kill(self, proc):
+        msg_trace('Canceller.kill(%d)' % proc.pid)
+        try:
+            if os.name == 'posix':
+                os.killpg(proc.pid, signal.SIGTERM)
+            else:
+                subprocess.call('taskkill /F /T /PID %d' % proc.pid,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            msg_trace('Canceller.kill(%d): %s' % (proc.pid, e))
 
 def translate_script(script):
     script = script or "rustc -vV && cargo -vV && cargo build --verbose && cargo test --verbose"